@@ -5,8 +5,28 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN environment variable not set")
 
-PROCESSED_FILE_IDS_PATH = "app/data/processed_files.json"
+PROCESSED_FILE_IDS_PATH = "app/data/processed_files.json"  # Legacy JSON set, imported into the index once
+PROCESSED_INDEX_PATH = os.getenv("PROCESSED_INDEX_PATH", "app/data/processed.db")
+# Bounds for the processed-file index: oldest entries are evicted past the limit
+PROCESSED_INDEX_MAX_ENTRIES = int(os.getenv("PROCESSED_INDEX_MAX_ENTRIES", "200000"))
+PROCESSED_INDEX_TTL_DAYS = int(os.getenv("PROCESSED_INDEX_TTL_DAYS", "180"))  # 0 disables expiry
+# Run compaction after this many new entries
+PROCESSED_INDEX_COMPACT_EVERY = int(os.getenv("PROCESSED_INDEX_COMPACT_EVERY", "500"))
+# How often lookups pick up keys other workers added to the shared index
+PROCESSED_INDEX_SYNC_SECONDS = float(os.getenv("PROCESSED_INDEX_SYNC_SECONDS", "5"))
 USER_DATA_FILE = "app/data/user_data.json"
+# Pending uploads per user: "sqlite" is shared by all workers and survives restarts, "memory" is per process
+USER_STATE_BACKEND = os.getenv("USER_STATE_BACKEND", "sqlite")
+USER_STATE_PATH = os.getenv("USER_STATE_PATH", "app/data/user_state.db")
+# Uploads never followed by /process are forgotten after this long
+USER_STATE_TTL_SECONDS = int(os.getenv("USER_STATE_TTL_SECONDS", str(24 * 3600)))
+USER_STATE_MAX_ENTRIES = int(os.getenv("USER_STATE_MAX_ENTRIES", "10000"))
+# Rendered variants cached by (input hash, mode, parameters) and re-sent by Telegram file_id
+OUTPUT_CACHE_PATH = os.getenv("OUTPUT_CACHE_PATH", "app/data/output_cache.db")
+OUTPUT_CACHE_DIR = os.getenv("OUTPUT_CACHE_DIR", "app/data/output_cache")
+# Disk budget for cached files; least recently used files go first (their file_ids are kept)
+OUTPUT_CACHE_MAX_MB = int(os.getenv("OUTPUT_CACHE_MAX_MB", "2048"))
+OUTPUT_CACHE_MAX_ENTRIES = int(os.getenv("OUTPUT_CACHE_MAX_ENTRIES", "50000"))
 
 PARAMETERS = {
     "brightness": {
@@ -42,3 +62,88 @@ PARAMETERS = {
 }
 
 PARAM_OPTIONS = [0.8, 1.0, 1.2]
+
+# Maximum number of FFmpeg processes running at the same time
+FFMPEG_CONCURRENCY = int(os.getenv("FFMPEG_CONCURRENCY", "2"))
+# Number of trailing FFmpeg stderr lines kept for error reports
+FFMPEG_STDERR_TAIL_LINES = int(os.getenv("FFMPEG_STDERR_TAIL_LINES", "40"))
+
+# Persistent job queue for /process requests
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "app/data/jobs.db")
+# Number of background workers pulling jobs from the queue (global concurrency cap)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Seconds an idle worker waits before polling the queue again
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+# Finished jobs older than this many seconds are purged on startup
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", str(7 * 24 * 3600)))
+# A claimed job is leased to its process; the lease is renewed every heartbeat
+# and jobs whose lease ran out (their process died) go back to the queue
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "15"))
+
+# JPEG quality used when photo variants are encoded in-process
+PHOTO_JPEG_QUALITY = int(os.getenv("PHOTO_JPEG_QUALITY", "92"))
+# zlib level used for PNG variants (lower is faster, larger files)
+PHOTO_PNG_COMPRESS_LEVEL = int(os.getenv("PHOTO_PNG_COMPRESS_LEVEL", "3"))
+# Upper bound on float32 elements processed at once when rendering photo variants
+PHOTO_BATCH_ELEMENTS = int(os.getenv("PHOTO_BATCH_ELEMENTS", str(48 * 1024 * 1024)))
+# In-process photo renders running at once across all jobs (each holds a full-resolution working set)
+PHOTO_RENDER_CONCURRENCY = int(os.getenv("PHOTO_RENDER_CONCURRENCY", "1"))
+
+# Chunk size and timeout for streaming downloads from Telegram
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(256 * 1024)))
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", "120"))
+
+# Number of parsed metadata results kept in the in-process LRU cache
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", "512"))
+
+# Cores the encode scheduler may hand out (0 = detect from the CPU affinity mask)
+ENCODER_CPU_COUNT = int(os.getenv("ENCODER_CPU_COUNT", "0"))
+
+# Variants rendered together (one decode) and delivered as one album
+VARIANT_CHUNK_SIZE = int(os.getenv("VARIANT_CHUNK_SIZE", "3"))
+# Items of an uploaded album that one job works on at the same time
+ALBUM_ITEM_CONCURRENCY = int(os.getenv("ALBUM_ITEM_CONCURRENCY", "3"))
+# Concurrent uploads to Telegram across all jobs
+DELIVERY_CONCURRENCY = int(os.getenv("DELIVERY_CONCURRENCY", "3"))
+# Minimum seconds between two sends to the same chat
+DELIVERY_CHAT_INTERVAL = float(os.getenv("DELIVERY_CHAT_INTERVAL", "1.0"))
+# Attempts per upload when Telegram answers with RetryAfter
+DELIVERY_MAX_ATTEMPTS = int(os.getenv("DELIVERY_MAX_ATTEMPTS", "3"))
+
+# Job workspaces live on tmpfs while the RAM budget allows, otherwise on disk
+WORKSPACE_RAM_DIR = os.getenv("WORKSPACE_RAM_DIR", "/dev/shm")
+WORKSPACE_RAM_BUDGET_MB = int(os.getenv("WORKSPACE_RAM_BUDGET_MB", "512"))
+# Estimated output size per variant relative to the input size
+WORKSPACE_SIZE_FACTOR = float(os.getenv("WORKSPACE_SIZE_FACTOR", "1.5"))
+
+# Videos at least this long (seconds) are split at keyframes and encoded in parallel segments
+SEGMENTED_MIN_DURATION = float(os.getenv("SEGMENTED_MIN_DURATION", "180"))
+# Shortest segment worth a separate FFmpeg process
+SEGMENT_MIN_SECONDS = float(os.getenv("SEGMENT_MIN_SECONDS", "30"))
+
+# Preview mode: short, downscaled renders; full quality only for picked variants
+PREVIEW_SECONDS = float(os.getenv("PREVIEW_SECONDS", "5"))
+PREVIEW_HEIGHT = int(os.getenv("PREVIEW_HEIGHT", "360"))
+PREVIEW_CRF = int(os.getenv("PREVIEW_CRF", "32"))
+
+# Near-duplicate check between the variants of a job (skipped in meta mode)
+VARIANT_CHECK_ENABLED = os.getenv("VARIANT_CHECK_ENABLED", "1") == "1"
+# Frames sampled per video variant, and the side of the RGB thumbnails compared
+VARIANT_CHECK_FRAMES = int(os.getenv("VARIANT_CHECK_FRAMES", "4"))
+VARIANT_CHECK_SIZE = int(os.getenv("VARIANT_CHECK_SIZE", "32"))
+# Two variants closer than this mean absolute thumbnail difference (8-bit levels) are near-duplicates
+VARIANT_MIN_DIFFERENCE = float(os.getenv("VARIANT_MIN_DIFFERENCE", "1.0"))
+# Re-renders with new parameters before a near-duplicate variant is dropped
+VARIANT_CHECK_RETRIES = int(os.getenv("VARIANT_CHECK_RETRIES", "1"))
+
+# Record encode fps from FFmpeg progress reports in the /metrics histogram
+METRICS_SAMPLE_FFMPEG_FPS = os.getenv("METRICS_SAMPLE_FFMPEG_FPS", "1") == "1"
+
+# Logging: "json" (one object per line) or "text"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Log a summary of every Nth webhook update instead of each update in full
+LOG_UPDATE_SAMPLE_EVERY = int(os.getenv("LOG_UPDATE_SAMPLE_EVERY", "50"))
+# FFmpeg command lines longer than this are shortened in INFO logs
+FFMPEG_LOG_COMMAND_CHARS = int(os.getenv("FFMPEG_LOG_COMMAND_CHARS", "300"))
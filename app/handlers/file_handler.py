@@ -1,71 +1,131 @@
 # app/handlers/file_handler.py
 
-import os
-import json
+import asyncio
 import logging
 from telegram import Update, PhotoSize
 from telegram.ext import ContextTypes
 
-from app.config import PROCESSED_FILE_IDS_PATH
 from app.utils.logging_config import logger
-from app.utils.user_state import USER_STATE  # Import shared USER_STATE
-
-PROCESSED_FILE_IDS = set()
-
-if os.path.exists(PROCESSED_FILE_IDS_PATH):
-    with open(PROCESSED_FILE_IDS_PATH, "r") as f:
-        PROCESSED_FILE_IDS = set(json.load(f))
-else:
-    PROCESSED_FILE_IDS = set()
-
-def save_processed_file_ids():
-    with open(PROCESSED_FILE_IDS_PATH, "w") as f:
-        json.dump(list(PROCESSED_FILE_IDS), f)
+from app.utils.user_state import user_state
+from app.utils.dedupe_index import processed_index, unique_id_key
+from app.utils.output_cache import output_cache
+from app.utils.metrics import time_stage
 
 async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
     user_id = update.effective_user.id
     file_id = None
+    file_unique_id = None
+    file_size = None
+    duration = None
     file_name = ""
     file_type = ""
     
-    logger.info(f"Handling file from user {user_id}")
+    logger.info("Handling file from user %s", user_id)
     
     if message.video:
         file_id = message.video.file_id
+        file_unique_id = message.video.file_unique_id
+        file_size = message.video.file_size
+        duration = message.video.duration
         file_name = message.video.file_name or "input_video.mp4"
         file_type = "video"
-        logger.info(f"Received video file: {file_id}, name: {file_name}")
+        logger.info("Received video file: %s, name: %s", file_id, file_name)
     elif message.photo:
         photo: PhotoSize = message.photo[-1]
         file_id = photo.file_id
+        file_unique_id = photo.file_unique_id
+        file_size = photo.file_size
         file_name = "input_photo.jpg"
         file_type = "photo"
-        logger.info(f"Received photo file: {file_id}, name: {file_name}")
+        logger.info("Received photo file: %s, name: %s", file_id, file_name)
     elif message.document:
         mime_type = message.document.mime_type
         if mime_type.startswith("video"):
             file_id = message.document.file_id
+            file_unique_id = message.document.file_unique_id
+            file_size = message.document.file_size
             file_name = message.document.file_name or "input_video.mp4"
             file_type = "video"
-            logger.info(f"Received document video file: {file_id}, name: {file_name}")
+            logger.info("Received document video file: %s, name: %s", file_id, file_name)
         elif mime_type.startswith("image"):
             file_id = message.document.file_id
+            file_unique_id = message.document.file_unique_id
+            file_size = message.document.file_size
             file_name = message.document.file_name or "input_photo.jpg"
             file_type = "photo"
-            logger.info(f"Received document image file: {file_id}, name: {file_name}")
+            logger.info("Received document image file: %s, name: %s", file_id, file_name)
     else:
         await message.reply_text("Пожалуйста, отправь действительный файл видео или фото.")
-        logger.warning(f"Unsupported file type from user {user_id}")
+        logger.warning("Unsupported file type from user %s", user_id)
         return
     
     if file_id:
-        USER_STATE[user_id] = {
+        # Known duplicates are recognised before a single byte is downloaded:
+        # served from the output cache if it still has their variants, rejected otherwise
+        with time_stage("dedupe_precheck", file_type):
+            already_processed, input_hash = await asyncio.to_thread(_precheck_duplicate, file_unique_id)
+        if already_processed and input_hash is None:
+            await message.reply_text("Этот файл уже был обработан ранее. Пожалуйста, отправь другой файл.")
+            logger.warning("File %s already processed, rejected before download for user %s", file_unique_id, user_id)
+            return
+        
+        state = {
             "file_id": file_id,
+            "file_unique_id": file_unique_id,
+            "file_size": file_size,
+            "duration": duration,
             "file_name": file_name,
             "file_type": file_type
         }
-        logger.info(f"Stored file_id for user {user_id}: {USER_STATE[user_id]}")
+        if input_hash:
+            # Lets the job re-send cached variants without downloading the file
+            state["input_hash"] = input_hash
+        if message.media_group_id:
+            await _add_album_item(message, user_id, state)
+            return
+        await asyncio.to_thread(user_state.set, user_id, state)
+        logger.info("Stored file_id for user %s: %s", user_id, state)
+        if input_hash:
+            await message.reply_text(
+                "Этот файл уже был обработан ранее — готовые варианты будут отправлены повторно без "
+                "перекодирования. Используй /process <n>, чтобы указать количество вариантов."
+            )
+            return
         await message.reply_text(
             "Файл получен! Теперь используй /process <n>, чтобы указать количество уникальных вариантов."
         )
+
+def _precheck_duplicate(file_unique_id):
+    # (already processed, input hash with cached outputs or None). Runs in a
+    # thread: both lookups are SQLite queries that can wait on a writer.
+    if not file_unique_id or unique_id_key(file_unique_id) not in processed_index:
+        return False, None
+    input_hash = output_cache.input_hash_for(file_unique_id)
+    if input_hash and not output_cache.has_outputs(input_hash):
+        input_hash = None
+    return True, input_hash
+
+async def _add_album_item(message, user_id, item):
+    # Telegram delivers an album as one update per item; collect them all
+    # under the media_group_id so a single /process handles the whole album
+    media_group_id = message.media_group_id
+    
+    def add_item(state):
+        if state is None or state.get("media_group_id") != media_group_id:
+            state = {"media_group_id": media_group_id, "items": []}
+        state["items"].append(item)
+        return state
+    
+    # BEGIN IMMEDIATE may wait on another worker's write; keep it off the event loop
+    state = await asyncio.to_thread(user_state.modify, user_id, add_item)
+    logger.info(
+        "Stored album item %d of media group %s for user %s: %s",
+        len(state["items"]), media_group_id, user_id, item,
+    )
+    # One reply per album, not per item
+    if len(state["items"]) == 1:
+        await message.reply_text(
+            "Альбом получен! Когда все файлы загрузятся, используй /process <n> — "
+            "для каждого файла будет создано n уникальных вариантов."
+        )
@@ -4,8 +4,11 @@ from telegram.ext import ContextTypes
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Как пользоваться ботом:\n"
-        "1. Отправь видео или фото (как Telegram media или документ).\n"
+        "1. Отправь видео или фото (как Telegram media или документ). Можно отправить альбом — он обработается одной задачей.\n"
         "2. Используй /process <n> (например, /process 3), чтобы сгенерировать n уникальных вариантов.\n"
         "Каждый вариант будет иметь небольшие изменения яркости, резкости, температуры, контраста и гаммы.\n"
+        "3. /process <n> meta — быстрые варианты только с новыми метаданными, без изменения изображения.\n"
+        "4. /process <n> preview — быстрые превью в низком качестве; нажми кнопку под ними, чтобы получить выбранный вариант в полном качестве.\n"
+        "Если отправить уже обработанный файл, готовые варианты придут повторно без перекодирования.\n"
         "Ты получишь подробные логи сравнения оригинальных и обновленных метаданных."
     )
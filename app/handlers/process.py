@@ -1,186 +1,649 @@
 # app/handlers/process.py
 
 import os
-import tempfile
-import json
-import io
-import random
+import asyncio
 import subprocess
-from telegram import Update, PhotoSize
+from telegram import Update, PhotoSize, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 
-from app.config import PARAMETERS, PROCESSED_FILE_IDS_PATH
-from app.utils.metadata import get_metadata, compare_metadata, get_file_hash
-from app.utils.file_processing import set_metadata_ffmpeg
+from app.config import (
+    PARAMETERS,
+    VARIANT_CHUNK_SIZE,
+    PREVIEW_SECONDS,
+    PREVIEW_HEIGHT,
+    ALBUM_ITEM_CONCURRENCY,
+    PHOTO_RENDER_CONCURRENCY,
+    VARIANT_CHECK_ENABLED,
+    VARIANT_CHECK_RETRIES,
+)
+from app.utils.metadata import get_metadata, compare_metadata, get_video_duration
+from app.utils.download import download_and_hash
+from app.utils.delivery import VariantDelivery
+from app.utils.workspace import workspace_manager, estimate_workspace_bytes
+from app.utils.file_processing import (
+    set_metadata_ffmpeg_batch_async,
+    supports_photo_fast_path,
+    process_photo_variants,
+    remux_metadata_variants_async,
+    rewrite_photo_metadata_variants,
+    should_segment,
+    split_video_segments,
+    set_metadata_ffmpeg_segmented_async,
+    render_video_previews_async,
+)
 from app.utils.logging_config import logger
-from app.utils.user_state import USER_STATE
+from app.utils.user_state import user_state
+from app.utils.job_queue import job_queue
+from app.utils.dedupe_index import processed_index, unique_id_key
+from app.utils.output_cache import output_cache
+from app.utils.sampling import HaltonSampler
+from app.utils.variant_check import VariantChecker
+from app.utils.metrics import BYTES_PROCESSED, OUTPUT_CACHE_LOOKUPS, NEAR_DUPLICATES, time_stage
 
-PROCESSED_FILE_IDS = set()
+# Variant modes: full re-encode with visual changes, new metadata only,
+# or cheap previews with full-quality renders of the variants the user picks
+MODE_FULL = "full"
+MODE_META = "meta"
+MODE_PREVIEW = "preview"
+VARIANT_MODES = {MODE_FULL, MODE_META, MODE_PREVIEW}
 
-# Load processed file IDs
-if os.path.exists(PROCESSED_FILE_IDS_PATH):
-    with open(PROCESSED_FILE_IDS_PATH, "r") as f:
-        PROCESSED_FILE_IDS = set(json.load(f))
-else:
-    PROCESSED_FILE_IDS = set()
+# Callback data prefix of the "render in full quality" buttons
+RENDER_CALLBACK_PREFIX = "render"
 
-def save_processed_file_ids():
-    with open(PROCESSED_FILE_IDS_PATH, "w") as f:
-        json.dump(list(PROCESSED_FILE_IDS), f)
+# Bot-wide cap on in-process photo renders; the FFmpeg slots do not cover them
+_photo_render_slots = asyncio.Semaphore(PHOTO_RENDER_CONCURRENCY)
 
-def generate_random_params():
-    return {
-        "brightness": round(random.uniform(0.9, 1.1), 3),
-        "sharpen": round(random.uniform(0.9, 1.1), 3),
-        "temp": round(random.uniform(0.9, 1.1), 3),
-        "contrast": round(random.uniform(0.9, 1.1), 3),
-        "gamma": round(random.uniform(0.9, 1.1), 3),
-    }
+# Every visual parameter is drawn from this range around the neutral 1.0
+PARAMETER_RANGE = (0.9, 1.1)
+
+def generate_variant_params(n, existing=()):
+    # n parameter sets from a randomly shifted Halton sequence, pairwise
+    # distinct and distinct from the existing ones, or None if that failed
+    names = list(PARAMETERS)
+    low, high = PARAMETER_RANGE
+    sampler = HaltonSampler(len(names))
+    used_combinations = {tuple(params[name] for name in names) for params in existing}
+    params_list = []
+    for i in range(1, n + 1):
+        max_attempts = 5
+        attempt = 0
+        while attempt < max_attempts:
+            point = sampler.next()
+            params = {name: round(low + (high - low) * u, 3) for name, u in zip(names, point)}
+            params_tuple = tuple(params[name] for name in names)
+            if params_tuple not in used_combinations:
+                used_combinations.add(params_tuple)
+                break
+            attempt += 1
+        else:
+            logger.error("Failed to generate unique parameters for variant %s", i)
+            return None
+        params_list.append(params)
+    return params_list
 
 async def process_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
     user_id = update.effective_user.id
     
-    logger.info(f"Processing command /process from user {user_id}")
+    logger.info("Processing command /process from user %s", user_id)
     
-    if user_id not in USER_STATE or "file_id" not in USER_STATE[user_id]:
+    # State and queue live in SQLite shared between workers; a busy database
+    # must not stall the event loop, so every call runs in a thread
+    state = await asyncio.to_thread(user_state.get, user_id)
+    if state is None or ("file_id" not in state and not state.get("items")):
         await message.reply_text("Нет сохраненного файла. Пожалуйста, сначала отправь видео или фото.")
-        logger.warning(f"No file_id found in USER_STATE for user {user_id}")
+        logger.warning("No file_id found in user state for user %s", user_id)
         return
     
     args = context.args
-    if len(args) != 1:
-        await message.reply_text("Использование: /process <n> (например, /process 3)")
-        logger.warning(f"Incorrect number of arguments for /process command from user {user_id}")
+    if len(args) not in (1, 2):
+        await message.reply_text("Использование: /process <n> [meta|preview] (например, /process 3 или /process 5 preview)")
+        logger.warning("Incorrect number of arguments for /process command from user %s", user_id)
         return
     
     try:
         n = int(args[0])
         if not (1 <= n <= 10):
             await message.reply_text("Пожалуйста, запроси от 1 до 10 вариантов.")
-            logger.warning(f"Invalid number of variants requested by user {user_id}: {n}")
+            logger.warning("Invalid number of variants requested by user %s: %s", user_id, n)
             return
     except ValueError:
         await message.reply_text("Пожалуйста, укажи действительное целое число (1-10).")
-        logger.warning(f"Non-integer argument for /process command from user {user_id}: {args[0]}")
+        logger.warning("Non-integer argument for /process command from user %s: %s", user_id, args[0])
+        return
+    
+    mode = args[1].lower() if len(args) == 2 else MODE_FULL
+    if mode not in VARIANT_MODES:
+        await message.reply_text("Неизвестный режим. Доступные режимы: meta, preview.")
+        logger.warning("Unknown /process mode from user %s: %s", user_id, args[1])
+        return
+    
+    # The job owns the file reference from now on
+    state = await asyncio.to_thread(user_state.pop, user_id)
+    if state is None:
+        # Expired, or claimed by a concurrent /process in another worker
+        await message.reply_text("Нет сохраненного файла. Пожалуйста, сначала отправь видео или фото.")
+        logger.warning("User state for user %s vanished before the job was queued", user_id)
+        return
+    payload = {
+        "chat_id": message.chat_id,
+        "message_id": message.message_id,
+        "n": n,
+        "mode": mode,
+        **state,
+    }
+    
+    with time_stage("enqueue", payload.get("file_type", "album")):
+        job_id, position = await asyncio.to_thread(job_queue.enqueue, user_id, payload)
+    logger.info("Queued job %s for user %s at position %s", job_id, user_id, position)
+    await message.reply_text(f"Задача добавлена в очередь. Твоя позиция: {position}.")
+
+class JobMessage:
+    # Replies on behalf of a queued job, threaded to the original /process message
+
+    def __init__(self, bot, chat_id, message_id):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+    def _reply_kwargs(self):
+        return {
+            "chat_id": self.chat_id,
+            "reply_to_message_id": self.message_id,
+            "allow_sending_without_reply": True,
+        }
+
+    async def reply_text(self, text, **kwargs):
+        return await self.bot.send_message(text=text, **self._reply_kwargs(), **kwargs)
+
+    async def reply_document(self, document, **kwargs):
+        return await self.bot.send_document(document=document, **self._reply_kwargs(), **kwargs)
+
+    async def reply_video(self, video, **kwargs):
+        return await self.bot.send_video(video=video, **self._reply_kwargs(), **kwargs)
+
+    async def reply_photo(self, photo, **kwargs):
+        return await self.bot.send_photo(photo=photo, **self._reply_kwargs(), **kwargs)
+
+    async def reply_media_group(self, media, **kwargs):
+        return await self.bot.send_media_group(media=media, **self._reply_kwargs(), **kwargs)
+
+def _render_keyboard(job_id, position, variant_indexes):
+    # position: 1-based item of the job (files of an album)
+    buttons = [
+        InlineKeyboardButton(f"#{i}", callback_data=f"{RENDER_CALLBACK_PREFIX}:{job_id}:{position}:{i}")
+        for i in variant_indexes
+    ]
+    rows = [buttons[start:start + 5] for start in range(0, len(buttons), 5)]
+    return InlineKeyboardMarkup(rows)
+
+async def render_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # A preview button was pressed: queue a full-quality render of that variant
+    query = update.callback_query
+    user_id = update.effective_user.id
+    try:
+        _, job_id, position, index = query.data.split(":")
+        job_id, position, index = int(job_id), int(position), int(index)
+    except ValueError:
+        await query.answer()
+        logger.warning("Malformed render callback from user %s: %s", user_id, query.data)
+        return
+    
+    preview_job = await asyncio.to_thread(job_queue.get_job, job_id)
+    if preview_job is None or preview_job["user_id"] != user_id or not preview_job["result"]:
+        await query.answer("Превью устарело. Пожалуйста, запусти /process заново.", show_alert=True)
+        logger.warning("Render callback for unknown preview job %s from user %s", job_id, user_id)
+        return
+    
+    preview_payload = preview_job["payload"]
+    items = preview_payload.get("items") or [preview_payload]
+    results = preview_job["result"]["items"]
+    result = results[position - 1] if 1 <= position <= len(results) else None
+    if result is None or index not in result["variant_indexes"]:
+        await query.answer()
         return
+    params = result["params"][result["variant_indexes"].index(index)]
+    
+    payload = {
+        **items[position - 1],
+        "chat_id": query.message.chat_id,
+        "message_id": query.message.message_id,
+        "mode": MODE_FULL,
+        "n": 1,
+        "variant_indexes": [index],
+        "params": [params],
+        "skip_dedupe": True,
+    }
+    render_job_id, queue_position = await asyncio.to_thread(job_queue.enqueue, user_id, payload)
+    logger.info(
+        "Queued full render %s of variant #%s (item %s) from preview job %s for user %s",
+        render_job_id, index, position, job_id, user_id,
+    )
+    await query.answer(f"Вариант #{index} добавлен в очередь (позиция {queue_position}).")
+
+async def _render_photos(input_path, outputs, max_side=None):
+    async with _photo_render_slots:
+        await asyncio.to_thread(process_photo_variants, input_path, outputs, max_side)
+
+def renders_in_process(input_path, file_type, mode):
+    # Photo variants rendered with NumPy from a single decode of the input
+    return file_type == "photo" and mode != MODE_META and supports_photo_fast_path(input_path)
+
+async def render_variants(input_path, file_type, mode, variants, segments=None):
+    # variants: list of (index, output_path, params); returns them once rendered.
+    # segments: keyframe-aligned pieces of a long input video, if it was split.
+    outputs = [(output_path, params) for _, output_path, params in variants]
+    with time_stage(f"render_{mode}", file_type):
+        if mode == MODE_META:
+            # No decode/encode: copy the media data and write new metadata only
+            if file_type == "photo" and supports_photo_fast_path(input_path):
+                await asyncio.to_thread(rewrite_photo_metadata_variants, input_path, outputs)
+            else:
+                await remux_metadata_variants_async(input_path, outputs)
+        elif mode == MODE_PREVIEW:
+            if file_type == "photo" and supports_photo_fast_path(input_path):
+                await _render_photos(input_path, outputs, PREVIEW_HEIGHT)
+            else:
+                await render_video_previews_async(input_path, outputs)
+        elif file_type == "photo" and supports_photo_fast_path(input_path):
+            # Photos are decoded once and rendered in-process, no FFmpeg spawn
+            await _render_photos(input_path, outputs)
+        elif segments:
+            # Long video: encode the segments in parallel and concatenate per variant
+            await set_metadata_ffmpeg_segmented_async(segments, outputs)
+        else:
+            # Decode the input once and write the whole chunk in a single FFmpeg pass
+            await set_metadata_ffmpeg_batch_async(input_path, outputs)
+    return variants
+
+async def _cache_outputs(input_hash, mode, file_type, outputs, reports):
+    # outputs: list of (index, path, params) that were just rendered.
+    # A metadata-only remux is cheaper to redo than to write out again, so
+    # only its entry is kept, for re-sending by Telegram file_id.
+    def store():
+        for i, output_path, params in outputs:
+            output_cache.put(
+                input_hash, mode, params, output_path, file_type, reports.get(i), keep_file=mode != MODE_META
+            )
+    try:
+        await asyncio.to_thread(store)
+    except Exception as e:
+        logger.warning("Could not cache rendered variants of %s: %s", input_hash, e)
+
+async def _drop_near_duplicates(checker, rendered, message, file_type, retries, final_params):
+    # Compare freshly rendered outputs with every variant accepted so far.
+    # Returns (unique, replacements): the outputs to deliver and the variants
+    # to render again with new parameters; the rest are dropped.
+    try:
+        with time_stage("variant_check", file_type):
+            distances = await checker.check([output_path for _, output_path, _ in rendered])
+    except Exception as e:
+        logger.warning("Variant check failed, delivering unchecked: %s", e)
+        return rendered, []
+    
+    unique = []
+    replacements = []
+    for (i, output_path, params), distance in zip(rendered, distances):
+        if checker.is_unique(distance):
+            unique.append((i, output_path, params))
+            continue
+        os.remove(output_path)
+        if retries.get(i, 0) < VARIANT_CHECK_RETRIES:
+            new_params = generate_variant_params(1, existing=list(final_params.values()))
+            if new_params is not None:
+                retries[i] = retries.get(i, 0) + 1
+                final_params[i] = new_params[0]
+                replacements.append((i, output_path, new_params[0]))
+                NEAR_DUPLICATES.inc(outcome="rerendered", file_type=file_type)
+                logger.info(
+                    "Variant #%s is %.2f levels from another variant, re-rendering with %s", i, distance, new_params[0]
+                )
+                continue
+        NEAR_DUPLICATES.inc(outcome="dropped", file_type=file_type)
+        logger.warning("Variant #%s is %.2f levels from another variant, dropped", i, distance)
+        await message.reply_text(f"Вариант #{i} получился слишком похожим на другой вариант и был пропущен.")
+    return unique, replacements
+
+async def _deliver_chunks(chunk_tasks, render_chunk, message, delivery, user_id, file_type, mode, original_meta,
+                          input_hash, checker=None):
+    # Deliver each chunk as soon as it is rendered while later ones keep
+    # encoding. With a checker, near-duplicate variants are re-rendered (new
+    # tasks are added to chunk_tasks so the caller can cancel them) or
+    # dropped. Returns {index: params} as finally rendered.
+    final_params = {i: params for chunk in chunk_tasks.values() for i, _, params in chunk}
+    retries = {}
+    pending = set(chunk_tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for finished in done:
+            try:
+                rendered = finished.result()
+            except subprocess.CalledProcessError as e:
+                await message.reply_text(f"Ошибка при генерации вариантов: {e}")
+                logger.error("FFmpeg batch processing failed for user %s: %s", user_id, e)
+                continue
+            except Exception as e:
+                await message.reply_text("Произошла непредвиденная ошибка при генерации вариантов.")
+                logger.error("Unexpected error during batch processing for user %s: %s", user_id, e)
+                continue
+            
+            found = []
+            for i, output_path, params in rendered:
+                if not os.path.isfile(output_path):
+                    logger.error("Processed file not found at %s for variant #%s", output_path, i)
+                    await message.reply_text(f"Ошибка: Обработанный файл для варианта #{i} не найден.")
+                    continue
+                logger.info("Processed file saved at %s for variant #%s", output_path, i)
+                found.append((i, output_path, params))
+            
+            if checker is not None and found:
+                found, replacements = await _drop_near_duplicates(
+                    checker, found, message, file_type, retries, final_params
+                )
+                if replacements:
+                    task = asyncio.create_task(render_chunk(replacements))
+                    chunk_tasks[task] = replacements
+                    pending.add(task)
+            
+            ready = []
+            for i, output_path, params in found:
+                if mode == MODE_PREVIEW:
+                    ready.append((i, output_path, params))
+                    continue
+                try:
+                    with time_stage("verify", file_type):
+                        updated_meta = await asyncio.to_thread(get_metadata, output_path, file_type)
+                    diff_text = compare_metadata(original_meta, updated_meta, PARAMETERS)
+                except Exception as e:
+                    logger.error("Failed to extract metadata for processed file %s: %s", output_path, e)
+                    await message.reply_text(f"Ошибка: Не удалось извлечь метаданные для варианта #{i}.")
+                    continue
+                
+                if mode == MODE_META:
+                    description = f"Вот вариант #{i} с уникальными метаданными (без перекодирования)."
+                else:
+                    description = f"Вот вариант #{i} с настройками яркости, резкости, температуры, контраста и гаммы."
+                delivery.add_report(
+                    i,
+                    f"{description}\n\n"
+                    f"--- Изменения в метаданных ---\n"
+                    f"{diff_text}"
+                )
+                ready.append((i, output_path, params))
+            # One media group per VARIANT_CHUNK_SIZE variants (in-process photo chunks hold all of them)
+            for start in range(0, len(ready), VARIANT_CHUNK_SIZE):
+                delivery.send([(i, output_path) for i, output_path, _ in ready[start:start + VARIANT_CHUNK_SIZE]])
+            if ready:
+                # Copied into the output cache while the upload runs
+                await _cache_outputs(input_hash, mode, file_type, ready, delivery.reports)
+    return final_params
+
+def _choose_params(payload, n, cached_params=()):
+    # (variant_indexes, params_list), or None if no unique parameters could
+    # be generated. Variants already rendered for this input come first.
+    if payload.get("params"):
+        # Full-quality render of variants picked from a preview
+        return payload["variant_indexes"], payload["params"]
+    params_list = list(cached_params[:n])
+    if len(params_list) < n:
+        fresh = generate_variant_params(n - len(params_list), existing=params_list)
+        if fresh is None:
+            return None
+        params_list += fresh
+    return list(range(1, n + 1)), params_list
+
+def _cached_outputs(input_hash, mode, output_ext, variant_indexes, params_list):
+    # index -> output cache entry, or None if the variant has to be rendered
+    return {
+        i: output_cache.lookup(input_hash, mode, params, output_ext)
+        for i, params in zip(variant_indexes, params_list)
+    }
+
+def _serve_cached(delivery, cached, file_type):
+    # Queue the cached variants on the delivery: by Telegram file_id when
+    # one is known, else the cached file is uploaded. Returns the indexes
+    # re-sent by file_id.
+    by_file_id = []
+    from_disk = []
+    for i, entry in sorted(cached.items()):
+        if entry is None:
+            OUTPUT_CACHE_LOOKUPS.inc(result="miss", file_type=file_type)
+            continue
+        if entry["telegram_file_id"]:
+            by_file_id.append((i, entry["telegram_file_id"]))
+            OUTPUT_CACHE_LOOKUPS.inc(result="file_id", file_type=file_type)
+        else:
+            # Evictions touch the least recently used files first, and the lookup just refreshed this one
+            from_disk.append((i, entry["path"]))
+            OUTPUT_CACHE_LOOKUPS.inc(result="file", file_type=file_type)
+        if entry["report"]:
+            delivery.add_report(i, entry["report"])
+    delivery.send_cached(by_file_id)
+    delivery.send(from_disk)
+    return [i for i, _ in by_file_id]
+
+def _record_file_ids(delivery, input_hash, mode, output_ext, variant_indexes, params_list, resent):
+    # Remember what Telegram assigned to fresh uploads; drop file_ids it rejected
+    params_by_index = dict(zip(variant_indexes, params_list))
+    try:
+        for i in resent:
+            if i in delivery.failed:
+                output_cache.set_file_id(input_hash, mode, params_by_index[i], output_ext, None)
+        for i, telegram_file_id in delivery.file_ids.items():
+            if i not in resent:
+                output_cache.set_file_id(input_hash, mode, params_by_index[i], output_ext, telegram_file_id)
+    except Exception as e:
+        logger.warning("Could not record Telegram file_ids of %s: %s", input_hash, e)
+
+async def _process_item(bot, job, message, item, label=None):
+    # Download, check, render and deliver one uploaded file. Returns the
+    # variant indexes and parameters used, or None if the file was skipped.
+    payload = job["payload"]
+    user_id = job["user_id"]
+    n = payload["n"]
+    mode = payload.get("mode", MODE_FULL)
+    file_id = item["file_id"]
+    file_name = item["file_name"]
+    file_type = item["file_type"]
+    file_unique_id = item.get("file_unique_id")
+    prefix = f"{label}: " if label else ""
+    
+    logger.info(
+        "Job %s: user %s has file_id: %s, file_type: %s, file_name: %s",
+        job["id"], user_id, file_id, file_type, file_name,
+    )
     
-    file_id = USER_STATE[user_id]["file_id"]
-    file_name = USER_STATE[user_id]["file_name"]
-    file_type = USER_STATE[user_id]["file_type"]
+    output_ext = os.path.splitext(file_name)[1]
+    output_prefix = "output"
+    if mode == MODE_PREVIEW:
+        output_prefix = "preview"
+        if file_type == "video":
+            output_ext = ".mp4"
     
-    logger.info(f"User {user_id} has file_id: {file_id}, file_type: {file_type}, file_name: {file_name}")
+    # A re-upload the output cache knows by its Telegram id: when every
+    # variant can be re-sent by file_id, nothing is downloaded or rendered
+    known_hash = item.get("input_hash")
+    if known_hash:
+        chosen = _choose_params(payload, n, output_cache.cached_params(known_hash, mode, output_ext))
+        if chosen is not None:
+            variant_indexes, params_list = chosen
+            cached = _cached_outputs(known_hash, mode, output_ext, variant_indexes, params_list)
+            if all(entry and entry["telegram_file_id"] for entry in cached.values()):
+                delivery = VariantDelivery(message, file_type, label)
+                resent = _serve_cached(delivery, cached, file_type)
+                await delivery.finish()
+                _record_file_ids(delivery, known_hash, mode, output_ext, variant_indexes, params_list, resent)
+                logger.info("Job %s: re-sent %d cached variant(s) without download", job["id"], len(resent))
+                return {"variant_indexes": variant_indexes, "params": params_list, "delivered": sorted(delivery.delivered)}
     
-    with tempfile.TemporaryDirectory() as tmp_dir:
+    # Segment copies and parts need room too. Documents arrive without a
+    # duration, so a full render of one is sized as if it will be segmented.
+    segmented = file_type == "video" and mode == MODE_FULL and (
+        item.get("duration") is None or should_segment(item.get("duration"))
+    )
+    estimated_bytes = estimate_workspace_bytes(item.get("file_size"), n, segmented)
+    workspace_label = f"job {job['id']} {label}" if label else f"job {job['id']}"
+    with workspace_manager.workspace(estimated_bytes, label=workspace_label) as tmp_dir:
         input_path = os.path.join(tmp_dir, file_name)
         try:
-            file_obj = await context.bot.get_file(file_id)
-            await file_obj.download_to_drive(input_path)
-            logger.info(f"Файл скачан в {input_path}")
+            with time_stage("download", file_type):
+                file_obj = await bot.get_file(file_id)
+                # The content hash is computed while the bytes arrive
+                file_hash = await download_and_hash(file_obj, input_path)
+            BYTES_PROCESSED.inc(os.path.getsize(input_path), direction="in", file_type=file_type)
+            logger.info("Файл скачан в %s", input_path)
         except Exception as e:
-            logger.error(f"Не удалось скачать файл для user {user_id}: {e}")
-            await message.reply_text("Не удалось скачать файл. Пожалуйста, попробуй снова.")
-            return
+            logger.error("Не удалось скачать файл для user %s: %s", user_id, e)
+            await message.reply_text(f"{prefix}Не удалось скачать файл. Пожалуйста, попробуй снова.")
+            return None
         
-        file_hash = get_file_hash(input_path)
-        if file_hash in PROCESSED_FILE_IDS:
-            await message.reply_text("Этот файл уже был обработан ранее. Пожалуйста, отправь другой файл.")
-            logger.warning(f"File {file_hash} already processed for user {user_id}")
-            return
-        PROCESSED_FILE_IDS.add(file_hash)
-        save_processed_file_ids()
+        cached_params = []
+        with time_stage("dedupe", file_type):
+            already_processed = not payload.get("skip_dedupe") and file_hash in processed_index
+        if payload.get("skip_dedupe"):
+            # Follow-up render of a file this bot already accepted
+            pass
+        elif already_processed:
+            # Remember the Telegram id too, so the next upload is recognised before download
+            if file_unique_id:
+                processed_index.add(unique_id_key(file_unique_id))
+            # A duplicate gets the variants rendered for it before, from the output cache
+            cached_params = output_cache.cached_params(file_hash, mode, output_ext)
+            if not cached_params:
+                await message.reply_text(f"{prefix}Этот файл уже был обработан ранее. Пожалуйста, отправь другой файл.")
+                logger.warning("File %s already processed for user %s", file_hash, user_id)
+                return None
+            logger.info("File %s already processed for user %s, serving cached variants", file_hash, user_id)
+        if file_unique_id:
+            output_cache.remember_input(file_unique_id, file_hash)
         
-        try:
-            original_meta = get_metadata(input_path, file_type)
-            logger.info(f"Original Metadata for user {user_id}: {original_meta}")
-        except Exception as e:
-            logger.error(f"Failed to extract metadata for user {user_id}: {e}")
-            await message.reply_text("Не удалось извлечь метаданные из файла. Пожалуйста, отправь другой файл.")
-            return
+        chosen = _choose_params(payload, n, cached_params)
+        if chosen is None:
+            await message.reply_text(f"{prefix}Не удалось сгенерировать уникальные параметры для варианта.")
+            return None
+        variant_indexes, params_list = chosen
+        cached = _cached_outputs(file_hash, mode, output_ext, variant_indexes, params_list)
         
-        await message.reply_text("Начинаю обработку. Пожалуйста, подожди...")
-        
-        used_combinations = set()
-        output_paths = []
-        for i in range(1, n + 1):
-            max_attempts = 5
-            attempt = 0
-            while attempt < max_attempts:
-                params = generate_random_params()
-                params_tuple = tuple(params[param] for param in PARAMETERS)
-                if params_tuple not in used_combinations:
-                    used_combinations.add(params_tuple)
-                    break
-                attempt += 1
-            else:
-                await message.reply_text("Не удалось сгенерировать уникальные параметры для варианта.")
-                logger.error(f"Failed to generate unique parameters for variant {i} for user {user_id}")
-                return
-            
+        variants = []
+        for i, params in zip(variant_indexes, params_list):
+            if cached[i] is not None:
+                continue
             logger.info(
-                f"Variant #{i} generated parameters for user {user_id}:\n"
-                f"Brightness: {params['brightness']}, Sharpen: {params['sharpen']}, "
-                f"Temperature: {params['temp']}, Contrast: {params['contrast']}, Gamma: {params['gamma']}"
+                "Variant #%s parameters for user %s:\n"
+                "Brightness: %s, Sharpen: %s, Temperature: %s, Contrast: %s, Gamma: %s",
+                i, user_id, params["brightness"], params["sharpen"], params["temp"], params["contrast"], params["gamma"],
             )
-            
-            try:
-                output_file = f"output_{i}{os.path.splitext(file_name)[1]}"
-                output_path = os.path.join(tmp_dir, output_file)
-                
-                set_metadata_ffmpeg(input_path, output_path, params)
-                
-                if os.path.isfile(output_path):
-                    logger.info(f"Processed file saved at {output_path} for variant #{i}")
-                else:
-                    logger.error(f"Processed file not found at {output_path} for variant #{i}")
-                    await message.reply_text(f"Ошибка: Обработанный файл для варианта #{i} не найден.")
-                    continue
-                
-                output_paths.append((output_path, params))
-            except subprocess.CalledProcessError as e:
-                await message.reply_text(f"Ошибка при генерации варианта #{i}: {e}")
-                logger.error(f"FFmpeg processing failed for variant #{i} for user {user_id}: {e}")
-                return
-            except Exception as e:
-                await message.reply_text(f"Произошла непредвиденная ошибка при генерации варианта #{i}.")
-                logger.error(f"Unexpected error for variant #{i} for user {user_id}: {e}")
-                return
+            variants.append((i, os.path.join(tmp_dir, f"{output_prefix}_{i}{output_ext}"), params))
         
-        for i, (path, meta) in enumerate(output_paths, 1):
-            if not os.path.isfile(path):
-                logger.error(f"Обработанный файл не найден: {path}")
-                await message.reply_text(f"Ошибка: Обработанный файл для варианта #{i} не найден.")
-                continue
+        original_meta = None
+        if variants:
             try:
-                updated_meta = get_metadata(path, file_type)
-                diff_text = compare_metadata(original_meta, updated_meta, PARAMETERS)
+                with time_stage("metadata", file_type):
+                    original_meta = await asyncio.to_thread(get_metadata, input_path, file_type, file_hash)
+                logger.info("Original Metadata for user %s: %s", user_id, original_meta)
             except Exception as e:
-                logger.error(f"Failed to extract metadata for processed file {path}: {e}")
-                await message.reply_text(f"Ошибка: Не удалось извлечь метаданные для варианта #{i}.")
-                continue
-            
-            summary = (
-                f"Вот вариант #{i} с настройками яркости, резкости, температуры, контраста и гаммы.\n\n"
-                f"--- Изменения в метаданных ---\n"
-                f"{diff_text}"
+                logger.error("Failed to extract metadata for user %s: %s", user_id, e)
+                await message.reply_text(f"{prefix}Не удалось извлечь метаданные из файла. Пожалуйста, отправь другой файл.")
+                return None
+        
+        if label is None:
+            await message.reply_text("Начинаю обработку. Пожалуйста, подожди...")
+        
+        duration = None
+        if variants and file_type == "video" and mode != MODE_META:
+            duration = item.get("duration") or await asyncio.to_thread(get_video_duration, input_path)
+        
+        segments = None
+        if variants and file_type == "video" and mode == MODE_FULL:
+            if should_segment(duration):
+                try:
+                    with time_stage("split", file_type):
+                        segments = await split_video_segments(input_path, os.path.join(tmp_dir, "segments"), duration)
+                except subprocess.CalledProcessError as e:
+                    logger.warning("Keyframe split failed for user %s, using a single process: %s", user_id, e)
+                if segments is not None and len(segments) < 2:
+                    segments = None
+        
+        # Metadata-only variants share the input's pixels; nothing to compare there
+        checker = None
+        if VARIANT_CHECK_ENABLED and mode != MODE_META and len(variants) > 1:
+            if mode == MODE_PREVIEW and duration:
+                duration = min(duration, PREVIEW_SECONDS)
+            checker = VariantChecker(file_type, duration)
+        
+        def render_chunk(chunk):
+            return render_variants(input_path, file_type, mode, chunk, segments)
+        
+        delivery = VariantDelivery(message, file_type, label)
+        resent = _serve_cached(delivery, cached, file_type)
+        if renders_in_process(input_path, file_type, mode):
+            # Chunking would decode the photo and hold its working set once per chunk
+            chunks = [variants] if variants else []
+        else:
+            chunks = [
+                variants[start:start + VARIANT_CHUNK_SIZE]
+                for start in range(0, len(variants), VARIANT_CHUNK_SIZE)
+            ]
+        chunk_tasks = {asyncio.create_task(render_chunk(chunk)): chunk for chunk in chunks}
+        
+        try:
+            final_params = await _deliver_chunks(
+                chunk_tasks, render_chunk, message, delivery, user_id, file_type, mode, original_meta,
+                file_hash, checker,
             )
-            log_file = io.StringIO(summary)
-            try:
-                await message.reply_document(
-                    document=log_file,
-                    filename=f"variant_{i}_logs.txt",
-                    caption=f"Логи для варианта #{i}"
-                )
-                with open(path, "rb") as file:
-                    if file_type == "video":
-                        await message.reply_video(video=file)
-                    elif file_type == "photo":
-                        await message.reply_photo(photo=file)
-            except Exception as e:
-                logger.error(f"Failed to send processed files to user {user_id}: {e}")
-                await message.reply_text(f"Ошибка: Не удалось отправить обработанный файл для варианта #{i}.")
-                continue
+        finally:
+            for task in chunk_tasks:
+                task.cancel()
+        # Near-duplicates that were re-rendered carry new parameters
+        params_list = [final_params.get(i, params) for i, params in zip(variant_indexes, params_list)]
+        
+        await delivery.finish()
+        _record_file_ids(delivery, file_hash, mode, output_ext, variant_indexes, params_list, resent)
+        if delivery.delivered and not payload.get("skip_dedupe") and not already_processed:
+            # Only now: a job re-queued after a crash must pass its own dedupe check
+            processed_index.add(file_hash)
+            if file_unique_id:
+                processed_index.add(unique_id_key(file_unique_id))
+        
+        logger.info("Processing completed for user %s", user_id)
+        return {"variant_indexes": variant_indexes, "params": params_list, "delivered": sorted(delivery.delivered)}
+
+async def run_process_job(bot, job):
+    payload = job["payload"]
+    message = JobMessage(bot, payload["chat_id"], payload["message_id"])
+    mode = payload.get("mode", MODE_FULL)
+    
+    # An album job lists its files under "items"; a single upload is its own item
+    items = payload.get("items") or [payload]
+    if len(items) == 1:
+        results = [await _process_item(bot, job, message, items[0])]
+    else:
+        await message.reply_text(f"Начинаю обработку альбома из {len(items)} файлов. Пожалуйста, подожди...")
+        # Items share the job's render pool; FFmpeg slots are capped bot-wide as well
+        item_slots = asyncio.Semaphore(ALBUM_ITEM_CONCURRENCY)
         
-        del USER_STATE[user_id]
-        logger.info(f"Processing completed for user {user_id}")
-        await message.reply_text("Всё готово! Отправь другой файл или используй /help для дополнительных команд.")
+        async def process_album_item(position, item):
+            async with item_slots:
+                return await _process_item(bot, job, message, item, label=f"Файл {position}/{len(items)}")
+        
+        results = await asyncio.gather(
+            *(process_album_item(position, item) for position, item in enumerate(items, start=1))
+        )
+    
+    if not any(results):
+        return
+    if mode == MODE_PREVIEW:
+        # Keep the exact parameters so picked variants render identically in full quality
+        job_queue.set_result(job["id"], {"items": [
+            {"variant_indexes": result["variant_indexes"], "params": result["params"]} if result else None
+            for result in results
+        ]})
+        for position, result in enumerate(results, start=1):
+            if not result or not result["delivered"]:
+                continue
+            text = "Превью готовы! Выбери варианты для рендера в полном качестве:"
+            if len(items) > 1:
+                text = f"Файл {position}/{len(items)}: {text}"
+            await message.reply_text(text, reply_markup=_render_keyboard(job["id"], position, result["delivered"]))
+        return
+    await message.reply_text("Всё готово! Отправь другой файл или используй /help для дополнительных команд.")
@@ -1,6 +1,13 @@
 # app/main.py
 
-import json
+import time
+
+# Import and startup timing, reported once the app is serving
+_import_started = time.perf_counter()
+
+import asyncio
+import logging
+import itertools
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Request, Response
@@ -8,21 +15,22 @@ from telegram import Update
 from telegram.ext import (
     Application,
     CommandHandler,
+    CallbackQueryHandler,
     MessageHandler,
     filters,
     ContextTypes,
 )
 
-from app.config import BOT_TOKEN
+from app.config import BOT_TOKEN, LOG_UPDATE_SAMPLE_EVERY
 from app.utils.logging_config import logger
 from app.handlers.start import start_command
 from app.handlers.help import help_command
-from app.handlers.process import process_command
+from app.handlers.process import process_command, render_callback, run_process_job
 from app.handlers.file_handler import handle_file
-from app.utils.metadata import get_file_hash
-
-# Initialize FastAPI
-app = FastAPI()
+from app.utils.job_queue import job_queue
+from app.utils.encoder import encode_scheduler
+from app.utils.dedupe_index import processed_index
+from app.utils.metrics import metrics, CONTENT_TYPE, QUEUE_DEPTH, JOBS_RUNNING, STARTUP_SECONDS
 
 # Initialize Telegram Bot Application
 application = Application.builder().token(BOT_TOKEN).build()
@@ -38,6 +46,9 @@ application.add_handler(CommandHandler("start", start_command))
 application.add_handler(CommandHandler("help", help_command))
 application.add_handler(CommandHandler("process", process_command))
 
+# Preview buttons queue full-quality renders
+application.add_handler(CallbackQueryHandler(render_callback, pattern=r"^render:"))
+
 # Register message handler for files
 application.add_handler(
     MessageHandler(
@@ -46,31 +57,86 @@ application.add_handler(
     )
 )
 
-@app.get("/")
-async def root():
-    return {"message": "metaOfmBot is running."}
+STARTUP_SECONDS.set(time.perf_counter() - _import_started, phase="import")
+logger.info("Imported app modules in %.3fs", time.perf_counter() - _import_started)
+
+_startup_finished = None
+
+async def _warm_dedupe_index():
+    # Build the in-memory filter off the event loop so the first upload does not pay for it
+    started = time.perf_counter()
+    try:
+        await asyncio.to_thread(processed_index.load)
+    except Exception as e:
+        logger.warning("Background load of the processed index failed: %s", e)
+        return
+    STARTUP_SECONDS.set(time.perf_counter() - started, phase="dedupe_index")
+    logger.info("Processed index loaded in %.3fs", time.perf_counter() - started)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global _startup_finished
     # Startup logic
+    startup_started = time.perf_counter()
     await application.initialize()
     await application.start()
+    # Background workers run queued /process jobs outside the webhook request
+    encode_scheduler.set_queue_depth_provider(job_queue.pending_count)
+    QUEUE_DEPTH.set_callback(job_queue.pending_count)
+    JOBS_RUNNING.set_callback(job_queue.running_count)
+    await job_queue.start(lambda job: run_process_job(application.bot, job))
+    warm_index = asyncio.create_task(_warm_dedupe_index())
+    _startup_finished = time.perf_counter()
+    STARTUP_SECONDS.set(_startup_finished - startup_started, phase="lifespan")
+    logger.info("Startup finished in %.3fs", _startup_finished - startup_started)
     try:
         yield  # Application runs during this time
     finally:
         # Shutdown logic
+        warm_index.cancel()
+        await job_queue.stop()
         await application.stop()
         await application.shutdown()
 
+# Initialize FastAPI
 app = FastAPI(lifespan=lifespan)
 
+@app.get("/")
+async def root():
+    return {"message": "metaOfmBot is running."}
+
+_updates_received = itertools.count(1)
+
+def _log_update(update):
+    # Full updates are never logged; a one-line summary goes to DEBUG for
+    # every update and to INFO for every LOG_UPDATE_SAMPLE_EVERY-th one.
+    received = next(_updates_received)
+    if received == 1 and _startup_finished is not None:
+        logger.info("First update arrived %.3fs after startup", time.perf_counter() - _startup_finished)
+    sampled = LOG_UPDATE_SAMPLE_EVERY > 0 and (received - 1) % LOG_UPDATE_SAMPLE_EVERY == 0
+    level = logging.INFO if sampled else logging.DEBUG
+    if not logger.isEnabledFor(level):
+        return
+    kind = "callback_query" if update.callback_query else "message" if update.message else "other"
+    user = update.effective_user
+    logger.log(
+        level,
+        "Received update %s (%s) from user %s; %d update(s) since start",
+        update.update_id, kind, user.id if user else None, received,
+    )
+
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
     try:
         update = Update.de_json(await request.json(), application.bot)
-        logger.info(f"Received update: {update}")
+        _log_update(update)
         await application.process_update(update)
     except Exception as e:
-        logger.error(f"Error processing update: {e}")
+        logger.error("Error processing update: %s", e)
         return Response(status_code=500)
     return Response(status_code=200)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    # Prometheus scrape target
+    return Response(content=metrics.render(), media_type=CONTENT_TYPE)
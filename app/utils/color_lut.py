@@ -0,0 +1,37 @@
+# app/utils/color_lut.py
+
+# NumPy is imported on first use to keep it off the startup import path
+
+# One entry per 8-bit input level
+LUT_SIZE = 256
+
+def compile_color_lut(params):
+    # Fold brightness, contrast, gamma and colour temperature into a single
+    # per-channel table. Returns a (3, LUT_SIZE) float32 array (R, G, B) in [0, 1].
+    import numpy as np
+
+    levels = np.linspace(0.0, 1.0, LUT_SIZE, dtype=np.float32)
+
+    # Same order as FFmpeg's eq filter: contrast around mid-grey, brightness offset, gamma
+    values = (levels - 0.5) * params["contrast"] + 0.5 + (params["brightness"] - 1.0)
+    values = np.clip(values, 0.0, 1.0) ** (1.0 / params["gamma"])
+
+    # Colour temperature: temp > 1 warms (more red, less blue), temp < 1 cools
+    temp = params["temp"]
+    lut = np.stack([values * temp, values, values * (2.0 - temp)])
+    return np.clip(lut, 0.0, 1.0).astype(np.float32)
+
+def compile_color_luts(params_list):
+    # (N, 3, LUT_SIZE) tables for a batch of variants
+    import numpy as np
+
+    return np.stack([compile_color_lut(params) for params in params_list])
+
+def write_cube_lut(params, path):
+    # Write the table as a 1D .cube file for FFmpeg's lut1d filter
+    lut = compile_color_lut(params)
+    lines = [f"LUT_1D_SIZE {LUT_SIZE}"]
+    lines += [f"{r:.6f} {g:.6f} {b:.6f}" for r, g, b in lut.T]
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return path
@@ -0,0 +1,252 @@
+# app/utils/dedupe_index.py
+
+import os
+import json
+import math
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+from app.config import (
+    PROCESSED_FILE_IDS_PATH,
+    PROCESSED_INDEX_PATH,
+    PROCESSED_INDEX_MAX_ENTRIES,
+    PROCESSED_INDEX_TTL_DAYS,
+    PROCESSED_INDEX_COMPACT_EVERY,
+    PROCESSED_INDEX_SYNC_SECONDS,
+)
+
+logger = logging.getLogger("metaOfmBot")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS processed (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    added_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_processed_added_at ON processed (added_at);
+CREATE TABLE IF NOT EXISTS index_meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO index_meta (name, value) VALUES ('generation', 0);
+"""
+
+def unique_id_key(file_unique_id):
+    # Telegram file_unique_id entries live next to content hashes under a prefix
+    return f"uid:{file_unique_id}"
+
+class BloomFilter:
+    # Fixed-size Bloom filter over string keys (double hashing on a BLAKE2b digest)
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(1, capacity)
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+class ProcessedIndex:
+    # Set of already-processed keys (content hashes, Telegram unique ids).
+    # SQLite in WAL mode is the source of truth and is safe to share between
+    # uvicorn workers; an in-memory Bloom filter answers most misses without
+    # touching the database. Rows written by other processes are picked up
+    # incrementally by id at most every sync_seconds, and a generation
+    # counter signals compactions. The filter is built on a separate
+    # connection without holding the lock; until it is swapped in, lookups
+    # are answered by SQLite alone.
+
+    def __init__(self, path, max_entries, ttl_days, compact_every, sync_seconds, legacy_json_path=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_days * 24 * 3600
+        self.compact_every = compact_every
+        self.sync_seconds = sync_seconds
+        self.legacy_json_path = legacy_json_path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._bloom = None
+        self._last_id = 0
+        self._generation = None
+        self._next_sync = 0.0
+        self._rebuilding = False
+        self._added_since_compact = 0
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+            self._import_legacy_json()
+        return self._conn
+
+    def _import_legacy_json(self):
+        if not self.legacy_json_path or not os.path.exists(self.legacy_json_path):
+            return
+        if self._conn.execute("SELECT 1 FROM processed LIMIT 1").fetchone():
+            return
+        try:
+            with open(self.legacy_json_path, "r") as f:
+                keys = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("Could not import legacy processed files from %s: %s", self.legacy_json_path, e)
+            return
+        now = time.time()
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO processed (key, added_at) VALUES (?, ?)",
+            ((key, now) for key in keys),
+        )
+        logger.info("Imported %s processed file hash(es) from %s", len(keys), self.legacy_json_path)
+
+    def _build_bloom(self):
+        # Reads every key through its own connection and snapshot, so the
+        # shared connection and the lock stay free for lookups meanwhile
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        try:
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute("BEGIN")
+            generation = conn.execute("SELECT value FROM index_meta WHERE name = 'generation'").fetchone()[0]
+            bloom = BloomFilter(self.max_entries)
+            last_id = 0
+            for row_id, key in conn.execute("SELECT id, key FROM processed ORDER BY id"):
+                bloom.add(key)
+                last_id = row_id
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return bloom, last_id, generation
+
+    def _load_new_rows(self, conn):
+        for row_id, key in conn.execute(
+            "SELECT id, key FROM processed WHERE id > ? ORDER BY id", (self._last_id,)
+        ):
+            self._bloom.add(key)
+            self._last_id = row_id
+
+    def _sync(self, conn):
+        # Catches the filter up with rows added since the last call. A
+        # compaction elsewhere makes it stale: it is dropped (lookups go to
+        # SQLite) and False is returned so the caller starts a rebuild.
+        self._next_sync = time.monotonic() + self.sync_seconds
+        generation = conn.execute("SELECT value FROM index_meta WHERE name = 'generation'").fetchone()[0]
+        if self._bloom is None or generation != self._generation:
+            self._bloom = None
+            return False
+        self._load_new_rows(conn)
+        return True
+
+    def load(self):
+        # (Re)build the Bloom filter and swap it in; a no-op while another
+        # thread is already building one
+        with self._lock:
+            self._connect()
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        try:
+            bloom, last_id, generation = self._build_bloom()
+            with self._lock:
+                self._bloom, self._last_id, self._generation = bloom, last_id, generation
+                # Rows added while the filter was being built
+                self._sync(self._conn)
+        finally:
+            with self._lock:
+                self._rebuilding = False
+
+    def _load_in_background(self):
+        def run():
+            try:
+                self.load()
+            except Exception as e:
+                logger.warning("Rebuilding the processed index filter failed: %s", e)
+
+        threading.Thread(target=run, name="processed-index-load", daemon=True).start()
+
+    def __contains__(self, key):
+        with self._lock:
+            conn = self._connect()
+            if self._bloom is not None and time.monotonic() >= self._next_sync:
+                self._sync(conn)
+            if self._bloom is not None and key not in self._bloom:
+                return False
+            found = conn.execute("SELECT 1 FROM processed WHERE key = ?", (key,)).fetchone() is not None
+            rebuild = self._bloom is None and not self._rebuilding
+        if rebuild:
+            self._load_in_background()
+        return found
+
+    def add(self, key):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR IGNORE INTO processed (key, added_at) VALUES (?, ?)",
+                (key, time.time()),
+            )
+            if self._bloom is not None:
+                self._bloom.add(key)
+            self._added_since_compact += 1
+            should_compact = self._added_since_compact >= self.compact_every
+        if should_compact:
+            self.compact()
+
+    def compact(self):
+        # Drop expired entries and the oldest entries beyond max_entries
+        with self._lock:
+            conn = self._connect()
+            self._added_since_compact = 0
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                removed = 0
+                if self.ttl_seconds > 0:
+                    removed += conn.execute(
+                        "DELETE FROM processed WHERE added_at < ?", (time.time() - self.ttl_seconds,)
+                    ).rowcount
+                removed += conn.execute(
+                    "DELETE FROM processed WHERE id NOT IN "
+                    "(SELECT id FROM processed ORDER BY id DESC LIMIT ?)",
+                    (self.max_entries,),
+                ).rowcount
+                if removed:
+                    conn.execute("UPDATE index_meta SET value = value + 1 WHERE name = 'generation'")
+                    generation = conn.execute("SELECT value FROM index_meta WHERE name = 'generation'").fetchone()[0]
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            if removed and self._bloom is not None and self._generation == generation - 1:
+                # Still a superset of the remaining keys: keep using it
+                # until the rebuild drops the removed ones
+                self._generation = generation
+        if removed:
+            self._load_in_background()
+            logger.info("Compacted processed index: removed %s entr(ies)", removed)
+        return removed
+
+processed_index = ProcessedIndex(
+    PROCESSED_INDEX_PATH,
+    max_entries=PROCESSED_INDEX_MAX_ENTRIES,
+    ttl_days=PROCESSED_INDEX_TTL_DAYS,
+    compact_every=PROCESSED_INDEX_COMPACT_EVERY,
+    sync_seconds=PROCESSED_INDEX_SYNC_SECONDS,
+    legacy_json_path=PROCESSED_FILE_IDS_PATH,
+)
@@ -0,0 +1,146 @@
+# app/utils/delivery.py
+
+import io
+import os
+import time
+import asyncio
+import logging
+from contextlib import ExitStack
+
+from telegram import InputMediaPhoto, InputMediaVideo
+from telegram.error import RetryAfter
+
+from app.config import DELIVERY_CONCURRENCY, DELIVERY_CHAT_INTERVAL, DELIVERY_MAX_ATTEMPTS
+from app.utils.metrics import BYTES_PROCESSED, time_stage
+
+logger = logging.getLogger("metaOfmBot")
+
+# Bot-wide cap on uploads in flight
+_upload_slots = asyncio.Semaphore(DELIVERY_CONCURRENCY)
+# chat_id -> earliest time the next send to that chat may start
+_chat_next_send = {}
+
+async def _wait_for_chat_turn(chat_id):
+    now = time.monotonic()
+    start_at = max(now, _chat_next_send.get(chat_id, now))
+    _chat_next_send[chat_id] = start_at + DELIVERY_CHAT_INTERVAL
+    if start_at > now:
+        await asyncio.sleep(start_at - now)
+
+async def _send_with_retry(chat_id, send):
+    # Pacing and rate-limit backoff wait outside the upload slots, so one
+    # throttled chat never holds them while other chats could be sending
+    for attempt in range(1, DELIVERY_MAX_ATTEMPTS + 1):
+        await _wait_for_chat_turn(chat_id)
+        try:
+            async with _upload_slots:
+                return await send()
+        except RetryAfter as e:
+            if attempt == DELIVERY_MAX_ATTEMPTS:
+                raise
+            logger.warning("Telegram rate limit for chat %s, retrying in %ss", chat_id, e.retry_after)
+            await asyncio.sleep(e.retry_after)
+
+class VariantDelivery:
+    # Uploads finished variants while later ones are still rendering. Each
+    # batch goes out as one media group; per-variant logs are collected and
+    # sent as a single report once everything has been delivered.
+
+    def __init__(self, message, file_type, label=None):
+        self.message = message
+        self.file_type = file_type
+        # Prefix for captions when the job covers several files (an album)
+        self.label = label
+        self.reports = {}
+        self.delivered = []
+        self.failed = []
+        # index -> Telegram file_id of the delivered variant
+        self.file_ids = {}
+        self._uploads = []
+
+    def add_report(self, index, text):
+        self.reports[index] = text
+
+    def send(self, items):
+        # items: list of (index, path); the upload runs in the background
+        if items:
+            self._uploads.append(asyncio.create_task(self._upload(items)))
+
+    def send_cached(self, items):
+        # items: list of (index, Telegram file_id); re-sent without uploading
+        if items:
+            self._uploads.append(asyncio.create_task(self._upload(items, cached=True)))
+
+    def _caption(self, indexes):
+        if len(indexes) == 1:
+            caption = f"Вариант #{indexes[0]}"
+        else:
+            caption = f"Варианты #{indexes[0]}–#{indexes[-1]}"
+        return f"{self.label}: {caption}" if self.label else caption
+
+    async def _send_items(self, items, cached=False):
+        indexes = [index for index, _ in items]
+        caption = self._caption(indexes)
+        with ExitStack() as stack:
+            # Telegram accepts a file_id string wherever it accepts a file
+            files = [source if cached else stack.enter_context(open(source, "rb")) for _, source in items]
+            if len(files) == 1:
+                if self.file_type == "video":
+                    return [await self.message.reply_video(video=files[0], caption=caption)]
+                return [await self.message.reply_photo(photo=files[0], caption=caption)]
+            media_class = InputMediaVideo if self.file_type == "video" else InputMediaPhoto
+            media = [
+                media_class(media=file, caption=caption if position == 0 else None)
+                for position, file in enumerate(files)
+            ]
+            return list(await self.message.reply_media_group(media=media))
+
+    def _sent_file_id(self, sent_message):
+        if self.file_type == "video":
+            video = getattr(sent_message, "video", None)
+            return video.file_id if video else None
+        photo = getattr(sent_message, "photo", None)
+        return photo[-1].file_id if photo else None
+
+    async def _upload(self, items, cached=False):
+        indexes = [index for index, _ in items]
+        try:
+            with time_stage("upload", self.file_type):
+                sent = await _send_with_retry(self.message.chat_id, lambda: self._send_items(items, cached))
+        except Exception as e:
+            logger.error("Failed to send variants %s to chat %s: %s", indexes, self.message.chat_id, e)
+            self.failed.extend(indexes)
+            return
+        self.delivered.extend(indexes)
+        for index, sent_message in zip(indexes, sent):
+            file_id = self._sent_file_id(sent_message)
+            if file_id:
+                self.file_ids[index] = file_id
+        if cached:
+            logger.info("Re-sent cached variants %s to chat %s by file_id", indexes, self.message.chat_id)
+            return sent
+        BYTES_PROCESSED.inc(sum(os.path.getsize(path) for _, path in items), direction="out", file_type=self.file_type)
+        logger.info("Delivered variants %s to chat %s", indexes, self.message.chat_id)
+        return sent
+
+    async def finish(self):
+        # The variants are out once the uploads are done; a failed notice or
+        # report is logged rather than failing a job that was delivered
+        await asyncio.gather(*self._uploads)
+        prefix = f"{self.label}: " if self.label else ""
+        try:
+            for index in sorted(self.failed):
+                await self.message.reply_text(f"{prefix}Ошибка: Не удалось отправить обработанный файл для варианта #{index}.")
+
+            if self.reports:
+                report = "\n\n".join(self.reports[index] for index in sorted(self.reports))
+                await _send_with_retry(
+                    self.message.chat_id,
+                    lambda: self.message.reply_document(
+                        document=io.BytesIO(report.encode("utf-8")),
+                        filename="variants_logs.txt",
+                        caption=f"{prefix}Логи для всех вариантов",
+                    ),
+                )
+        except Exception as e:
+            logger.error("Failed to send the variant report to chat %s: %s", self.message.chat_id, e)
@@ -0,0 +1,43 @@
+# app/utils/download.py
+
+import asyncio
+import hashlib
+import logging
+from urllib.parse import urlparse
+
+import httpx
+
+from app.config import DOWNLOAD_CHUNK_SIZE, DOWNLOAD_TIMEOUT
+
+logger = logging.getLogger("metaOfmBot")
+
+def _copy_and_hash(source_path, dest_path):
+    sha256 = hashlib.sha256()
+    with open(source_path, "rb") as src, open(dest_path, "wb") as dst:
+        for chunk in iter(lambda: src.read(DOWNLOAD_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+            dst.write(chunk)
+    return sha256.hexdigest()
+
+async def download_and_hash(file_obj, dest_path):
+    # Stream a telegram.File to dest_path, computing its SHA-256 on the fly
+    # so the file never has to be read a second time just to be hashed.
+    source = str(file_obj.file_path)
+    if urlparse(source).scheme not in ("http", "https"):
+        # Local Bot API server: file_path is already a path on this machine
+        file_hash = await asyncio.to_thread(_copy_and_hash, source, dest_path)
+        logger.info("Copied local file to %s", dest_path)
+        return file_hash
+
+    sha256 = hashlib.sha256()
+    size = 0
+    async with httpx.AsyncClient(timeout=DOWNLOAD_TIMEOUT) as client:
+        async with client.stream("GET", source) as response:
+            response.raise_for_status()
+            with open(dest_path, "wb") as f:
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    sha256.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+    logger.info("Downloaded %s bytes to %s", size, dest_path)
+    return sha256.hexdigest()
@@ -0,0 +1,201 @@
+# app/utils/encoder.py
+
+import os
+import asyncio
+import logging
+import subprocess
+from collections import deque
+from typing import NamedTuple
+
+from app.config import (
+    FFMPEG_CONCURRENCY,
+    FFMPEG_STDERR_TAIL_LINES,
+    FFMPEG_LOG_COMMAND_CHARS,
+    ENCODER_CPU_COUNT,
+    METRICS_SAMPLE_FFMPEG_FPS,
+)
+from app.utils.metrics import FFMPEG_ACTIVE, FFMPEG_FPS
+
+logger = logging.getLogger("metaOfmBot")
+
+# Global cap on concurrently running FFmpeg processes
+_ffmpeg_slots = asyncio.Semaphore(FFMPEG_CONCURRENCY)
+
+def format_command(cmd, limit=FFMPEG_LOG_COMMAND_CHARS):
+    # Command line for INFO logs; filter graphs and long paths get shortened
+    text = " ".join(str(arg) for arg in cmd)
+    if limit and len(text) > limit:
+        return f"{text[:limit]}... ({len(text) - limit} more chars)"
+    return text
+
+def output_tail(output, lines=FFMPEG_STDERR_TAIL_LINES):
+    # Last lines of captured FFmpeg output, decoded for logging
+    if not output:
+        return ""
+    return b"\n".join(output.splitlines()[-lines:]).decode("utf-8", errors="replace")
+
+class EncodeProfile(NamedTuple):
+    threads: int
+    preset: str
+    crf: int
+
+# Used when no scheduler decision is available (e.g. synchronous helpers)
+DEFAULT_PROFILE = EncodeProfile(threads=1, preset="ultrafast", crf=23)
+
+def _available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+class EncodeScheduler:
+    # Hands each encode a thread allotment and x264 preset/CRF based on how
+    # many encodes are running and how many jobs are waiting: a lone job gets
+    # most of the machine and a slower, more efficient preset, while a busy
+    # box packs single-threaded ultrafast encodes.
+
+    def __init__(self, cpu_count=None):
+        self.cpu_count = cpu_count or _available_cpus()
+        self.active = 0
+        self._queue_depth_provider = None
+
+    def set_queue_depth_provider(self, provider):
+        self._queue_depth_provider = provider
+
+    def queue_depth(self):
+        if self._queue_depth_provider is None:
+            return 0
+        try:
+            return self._queue_depth_provider()
+        except Exception as e:
+            logger.warning("Could not read queue depth for the encode scheduler: %s", e)
+            return 0
+
+    def allot(self, label):
+        queue_depth = self.queue_depth()
+        # Encodes competing for cores: running ones, this one and waiting jobs
+        demand = self.active + 1 + queue_depth
+        threads = max(1, self.cpu_count // demand)
+        if threads >= 4:
+            profile = EncodeProfile(threads=threads, preset="veryfast", crf=22)
+        elif threads >= 2:
+            profile = EncodeProfile(threads=threads, preset="superfast", crf=23)
+        else:
+            profile = DEFAULT_PROFILE
+        logger.info(
+            "Encode scheduler [%s]: cpus=%d, active=%d, queued=%d -> threads=%d, preset=%s, crf=%d",
+            label, self.cpu_count, self.active, queue_depth, profile.threads, profile.preset, profile.crf,
+        )
+        return profile
+
+encode_scheduler = EncodeScheduler(ENCODER_CPU_COUNT or None)
+FFMPEG_ACTIVE.set_callback(lambda: encode_scheduler.active)
+
+async def _read_progress(stream, label, on_progress):
+    # FFmpeg "-progress" output is a series of key=value blocks,
+    # each terminated by a "progress=continue" or "progress=end" line.
+    block = {}
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        key, _, value = line.decode("utf-8", errors="replace").strip().partition("=")
+        if not key:
+            continue
+        block[key] = value
+        if key == "progress":
+            logger.debug(
+                "FFmpeg progress [%s]: frame=%s, fps=%s, time=%s, speed=%s",
+                label, block.get("frame"), block.get("fps"), block.get("out_time"), block.get("speed"),
+            )
+            if on_progress is not None:
+                on_progress(block)
+            if value == "end" and METRICS_SAMPLE_FFMPEG_FPS:
+                # The final report carries the average fps of the whole run
+                try:
+                    fps = float(block.get("fps", 0))
+                except ValueError:
+                    fps = 0
+                if fps > 0:
+                    FFMPEG_FPS.observe(fps)
+            block = {}
+
+async def _read_stderr_tail(stream, tail):
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        tail.append(line)
+
+async def run_ffmpeg(cmd, label="ffmpeg", on_progress=None):
+    # cmd is either an argument list or a callable that builds one from the
+    # EncodeProfile the scheduler allots once a slot is free.
+    stderr_tail = deque(maxlen=FFMPEG_STDERR_TAIL_LINES)
+
+    async with _ffmpeg_slots:
+        if callable(cmd):
+            cmd = cmd(encode_scheduler.allot(label))
+        # Report machine-readable progress on stdout and keep stderr for diagnostics
+        cmd = [cmd[0], "-nostats", "-progress", "pipe:1"] + list(cmd[1:])
+        logger.info("Running FFmpeg command [%s]: %s", label, format_command(cmd))
+        logger.debug("Full FFmpeg command [%s]: %s", label, cmd)
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        encode_scheduler.active += 1
+        try:
+            await asyncio.gather(
+                _read_progress(process.stdout, label, on_progress),
+                _read_stderr_tail(process.stderr, stderr_tail),
+            )
+            returncode = await process.wait()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        finally:
+            encode_scheduler.active -= 1
+
+    if returncode != 0:
+        stderr = b"".join(stderr_tail)
+        logger.error(
+            "FFmpeg [%s] exited with code %d.\nCommand: %s\nStderr (last %d lines):\n%s",
+            label, returncode, format_command(cmd, limit=0), len(stderr_tail), output_tail(stderr),
+        )
+        raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr)
+
+    logger.info("FFmpeg [%s] finished successfully", label)
+
+async def capture_ffmpeg(cmd, label="ffmpeg"):
+    # Short FFmpeg run whose result is on stdout (e.g. raw frames). Shares
+    # the global slots with the encodes; returns the stdout bytes.
+    async with _ffmpeg_slots:
+        logger.debug("Running FFmpeg command [%s]: %s", label, format_command(cmd))
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        encode_scheduler.active += 1
+        try:
+            stdout, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        finally:
+            encode_scheduler.active -= 1
+
+    if process.returncode != 0:
+        logger.error(
+            "FFmpeg [%s] exited with code %d.\nCommand: %s\nStderr:\n%s",
+            label, process.returncode, format_command(cmd, limit=0), output_tail(stderr),
+        )
+        raise subprocess.CalledProcessError(process.returncode, cmd, output=stdout, stderr=stderr)
+    return stdout
@@ -1,60 +1,494 @@
 # app/utils/file_processing.py
 
 import os
+import glob
+import zlib
+import asyncio
+import struct
+import tempfile
 import subprocess
 import logging
 
+from app.config import (
+    PHOTO_JPEG_QUALITY,
+    PHOTO_PNG_COMPRESS_LEVEL,
+    PHOTO_BATCH_ELEMENTS,
+    SEGMENTED_MIN_DURATION,
+    SEGMENT_MIN_SECONDS,
+    PREVIEW_SECONDS,
+    PREVIEW_HEIGHT,
+    PREVIEW_CRF,
+)
+from app.utils.color_lut import LUT_SIZE, compile_color_luts, write_cube_lut
+from app.utils.encoder import DEFAULT_PROFILE, encode_scheduler, run_ffmpeg, format_command, output_tail
+
 logger = logging.getLogger("metaOfmBot")
 
-def set_metadata_ffmpeg(input_path, output_path, metadata_dict):
-    # Calculate filter values
-    brightness_eq = metadata_dict['brightness'] - 1.0
-    contrast_eq = metadata_dict['contrast']
-    gamma_eq = metadata_dict['gamma']
+# NumPy, Pillow and piexif are imported inside the photo functions: nothing
+# needs them until the first media job, and they add to cold-start time.
+
+def build_video_filters(metadata_dict, lut_path, scale_height=None):
+    # Brightness, contrast, gamma and temperature are folded into one 1D LUT
     sharpen_amount = metadata_dict['sharpen']
-    
-    # Define video filters
-    vf_filters = (
-        f"eq=brightness={brightness_eq}:contrast={contrast_eq}:gamma={gamma_eq},"
-        f"unsharp=5:5:{sharpen_amount}"
+    # Previews are downscaled first so the rest of the chain runs on fewer pixels
+    scale = f"scale=-2:{scale_height}," if scale_height else ""
+
+    # The LUT works in RGB; convert back to 4:2:0 so players keep decoding the output
+    return (
+        f"{scale}"
+        f"lut1d=file='{lut_path}',"
+        f"unsharp=5:5:{sharpen_amount},"
+        f"format=yuv420p"
     )
-    
+
+def lut_path_for(output_path):
+    # The path is spliced into the filtergraph unescaped, and output names
+    # carry the user's file extension: give the LUT a name of our own
+    # (letters, digits, underscores) next to the output, in the workspace
+    fd, path = tempfile.mkstemp(prefix="lut_", suffix=".cube", dir=os.path.dirname(output_path) or None)
+    os.close(fd)
+    return path
+
+def write_variant_luts(outputs):
+    return [write_cube_lut(params, lut_path_for(output_path)) for output_path, params in outputs]
+
+def remove_variant_luts(lut_paths):
+    for lut_path in lut_paths:
+        try:
+            os.remove(lut_path)
+        except FileNotFoundError:
+            pass
+
+def build_comment_metadata(metadata_dict):
     # Format metadata with semicolons to avoid FFmpeg parsing issues
-    comment_metadata = (
+    return (
         f"Brightness={metadata_dict['brightness']}; "
         f"Sharpen={metadata_dict['sharpen']}; "
         f"Temperature={metadata_dict['temp']}; "
         f"Contrast={metadata_dict['contrast']}; "
         f"Gamma={metadata_dict['gamma']}"
     )
-    
-    # FFmpeg command with optimizations
+
+def build_batch_command(input_path, outputs, lut_paths, profile=DEFAULT_PROFILE,
+                        duration_limit=None, scale_height=None):
+    # One decode of the input, split into one filter branch per variant,
+    # each branch mapped to its own output file with its own comment.
+    count = len(outputs)
+    if count == 1:
+        filter_graph = f"[0:v]{build_video_filters(outputs[0][1], lut_paths[0], scale_height)}[v0]"
+    else:
+        split_labels = "".join(f"[s{idx}]" for idx in range(count))
+        branches = [
+            f"[s{idx}]{build_video_filters(params, lut_path, scale_height)}[v{idx}]"
+            for idx, ((_, params), lut_path) in enumerate(zip(outputs, lut_paths))
+        ]
+        filter_graph = f"[0:v]split={count}{split_labels};" + ";".join(branches)
+
+    # The allotment is shared by the decoder, the filter graph and all encoders
+    encoder_threads = max(1, profile.threads // count)
     cmd = [
         "ffmpeg",
         "-y",  # Overwrite output files without asking
-        "-threads", "1",  # Limit to 1 thread to reduce CPU usage
+        "-threads", str(profile.threads),  # Decoder threads allotted by the scheduler
+    ]
+    if duration_limit:
+        cmd += ["-t", str(duration_limit)]  # Only decode the beginning of the input
+    cmd += [
         "-i", input_path,
-        "-vf", vf_filters,
-        "-preset", "ultrafast",  # Use ultrafast preset to minimize CPU usage
-        "-metadata", f"comment={comment_metadata}",
-        "-c:a", "copy",  # Copy audio without re-encoding
-        output_path
+        "-filter_complex_threads", str(profile.threads),
+        "-filter_complex", filter_graph,
     ]
-    
-    logger.info(f"Running FFmpeg command: {' '.join(cmd)}")
+    for idx, (output_path, params) in enumerate(outputs):
+        cmd += [
+            "-map", f"[v{idx}]",
+            "-map", "0:a?",  # Keep audio if the input has any
+            "-threads", str(encoder_threads),
+            "-preset", profile.preset,
+            "-crf", str(profile.crf),
+            "-metadata", f"comment={build_comment_metadata(params)}",
+            "-c:a", "copy",  # Copy audio without re-encoding
+            output_path,
+        ]
+    return cmd
+
+def set_metadata_ffmpeg_batch(input_path, outputs):
+    # outputs: list of (output_path, metadata_dict) tuples
+    if not outputs:
+        return
+
+    lut_paths = write_variant_luts(outputs)
+    cmd = build_batch_command(input_path, outputs, lut_paths)
+
+    logger.info("Running FFmpeg batch command for %d variant(s): %s", len(outputs), format_command(cmd))
     try:
-        # Execute the FFmpeg command
         result = subprocess.run(
             cmd,
             check=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE
         )
-        logger.info(f"FFmpeg output: {result.stdout.decode('utf-8')}")
-        logger.info(f"Metadata update and video processing successful: {output_path}")
+        logger.debug("FFmpeg output: %s", output_tail(result.stdout))
+        logger.info(
+            "Metadata update and video processing successful: %s",
+            ", ".join(output_path for output_path, _ in outputs),
+        )
     except subprocess.CalledProcessError as e:
-        logger.error("Failed to set metadata and process video.")
-        logger.error(f"Command: {' '.join(cmd)}")
-        logger.error(f"Stdout: {e.stdout.decode('utf-8', errors='replace')}")
-        logger.error(f"Stderr: {e.stderr.decode('utf-8', errors='replace')}")
+        logger.error(
+            "Failed to set metadata and process video.\nCommand: %s\nStderr (tail):\n%s",
+            format_command(cmd, limit=0), output_tail(e.stderr),
+        )
         raise
+    finally:
+        remove_variant_luts(lut_paths)
+
+async def set_metadata_ffmpeg_batch_async(input_path, outputs):
+    # Same as set_metadata_ffmpeg_batch, but runs FFmpeg without blocking the event loop
+    if not outputs:
+        return
+
+    lut_paths = write_variant_luts(outputs)
+    try:
+        await run_ffmpeg(
+            lambda profile: build_batch_command(input_path, outputs, lut_paths, profile),
+            label=f"{os.path.basename(input_path)} x{len(outputs)}",
+        )
+    finally:
+        remove_variant_luts(lut_paths)
+    logger.info("Metadata update and video processing successful: %s", ", ".join(output_path for output_path, _ in outputs))
+
+# Segmented mode for long videos: split at keyframes, encode segments in
+# parallel FFmpeg processes, then concatenate each variant losslessly.
+
+def should_segment(duration):
+    return bool(duration) and duration >= SEGMENTED_MIN_DURATION
+
+async def split_video_segments(input_path, segment_dir, duration):
+    # Stream-copy split; the segment muxer only cuts on keyframes
+    os.makedirs(segment_dir, exist_ok=True)
+    segment_count = max(2, encode_scheduler.cpu_count)
+    segment_seconds = max(SEGMENT_MIN_SECONDS, duration / segment_count)
+    ext = os.path.splitext(input_path)[1] or ".mp4"
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-i", input_path,
+        "-map", "0:v",
+        "-map", "0:a?",
+        "-c", "copy",
+        "-f", "segment",
+        "-segment_time", f"{segment_seconds:.3f}",
+        "-reset_timestamps", "1",
+        os.path.join(segment_dir, f"segment_%04d{ext}"),
+    ]
+    await run_ffmpeg(cmd, label=f"{os.path.basename(input_path)} split")
+    segments = sorted(glob.glob(os.path.join(segment_dir, f"segment_*{ext}")))
+    logger.info("Split %s (%.1fs) into %d segment(s) of ~%.1fs", input_path, duration, len(segments), segment_seconds)
+    return segments
+
+def build_concat_command(list_path, output_path, params):
+    return [
+        "ffmpeg",
+        "-y",
+        "-f", "concat",
+        "-safe", "0",
+        "-i", list_path,
+        "-map", "0",
+        "-c", "copy",
+        "-metadata", f"comment={build_comment_metadata(params)}",
+        output_path,
+    ]
+
+def _write_concat_list(list_path, part_paths):
+    with open(list_path, "w") as f:
+        for part_path in part_paths:
+            escaped = part_path.replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+
+async def _gather_or_cancel(coroutines):
+    # Like gather(), but a failure cancels the remaining FFmpeg processes
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def set_metadata_ffmpeg_segmented_async(segments, outputs):
+    # Every segment is decoded once for all variants in its own FFmpeg process;
+    # the per-variant parts are then joined with the concat demuxer.
+    if not outputs:
+        return
+
+    # The parts are joined with a stream copy, and the concat demuxer keeps
+    # only the first part's codec header: every segment must be encoded with
+    # the same preset and CRF, so the profile is allotted once for the whole
+    # render. Only the thread count follows the scheduler per segment.
+    profile = encode_scheduler.allot(f"{os.path.basename(outputs[0][0])} segmented x{len(outputs)}")
+
+    lut_paths = write_variant_luts(outputs)
+    part_paths = [
+        [f"{output_path}.part{idx:04d}{os.path.splitext(output_path)[1]}" for idx in range(len(segments))]
+        for output_path, _ in outputs
+    ]
+    list_paths = [f"{output_path}.concat.txt" for output_path, _ in outputs]
+    try:
+        await _gather_or_cancel(
+            run_ffmpeg(
+                lambda allotted, segment=segment, idx=idx: build_batch_command(
+                    segment,
+                    [(part_paths[variant][idx], params) for variant, (_, params) in enumerate(outputs)],
+                    lut_paths,
+                    profile._replace(threads=allotted.threads),
+                ),
+                label=f"{os.path.basename(segment)} x{len(outputs)}",
+            )
+            for idx, segment in enumerate(segments)
+        )
+
+        concat_commands = []
+        for (output_path, params), parts, list_path in zip(outputs, part_paths, list_paths):
+            _write_concat_list(list_path, parts)
+            concat_commands.append(
+                run_ffmpeg(
+                    build_concat_command(list_path, output_path, params),
+                    label=f"{os.path.basename(output_path)} concat",
+                )
+            )
+        await _gather_or_cancel(concat_commands)
+    finally:
+        remove_variant_luts(lut_paths)
+        for path in list_paths + [part for parts in part_paths for part in parts]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    logger.info(
+        "Segmented processing successful over %d segment(s): %s",
+        len(segments), ", ".join(output_path for output_path, _ in outputs),
+    )
+
+async def render_video_previews_async(input_path, outputs):
+    # Short, downscaled, low-bitrate renders of each variant
+    if not outputs:
+        return
+
+    lut_paths = write_variant_luts(outputs)
+    try:
+        await run_ffmpeg(
+            lambda profile: build_batch_command(
+                input_path,
+                outputs,
+                lut_paths,
+                profile._replace(preset="ultrafast", crf=PREVIEW_CRF),
+                duration_limit=PREVIEW_SECONDS,
+                scale_height=PREVIEW_HEIGHT,
+            ),
+            label=f"{os.path.basename(input_path)} preview x{len(outputs)}",
+        )
+    finally:
+        remove_variant_luts(lut_paths)
+    logger.info("Rendered %d preview(s): %s", len(outputs), ", ".join(output_path for output_path, _ in outputs))
+
+def set_metadata_ffmpeg(input_path, output_path, metadata_dict):
+    set_metadata_ffmpeg_batch(input_path, [(output_path, metadata_dict)])
+
+# Photo formats rendered in-process instead of through FFmpeg
+PHOTO_FAST_PATH_FORMATS = {
+    ".jpg": "JPEG",
+    ".jpeg": "JPEG",
+    ".png": "PNG",
+}
+
+def supports_photo_fast_path(path):
+    return os.path.splitext(path)[1].lower() in PHOTO_FAST_PATH_FORMATS
+
+def _box_blur(pixels, radius):
+    # Separable mean filter with edge padding, computed with cumulative sums
+    import numpy as np
+
+    size = 2 * radius + 1
+    for axis in (0, 1):
+        pad = [(0, 0)] * pixels.ndim
+        pad[axis] = (radius + 1, radius)
+        padded = np.pad(pixels, pad, mode="edge")
+        summed = np.cumsum(padded, axis=axis, dtype=np.float32)
+        upper = np.take(summed, np.arange(size, summed.shape[axis]), axis=axis)
+        lower = np.take(summed, np.arange(0, summed.shape[axis] - size), axis=axis)
+        pixels = (upper - lower) / size
+    return pixels
+
+def _render_photo_batch(lut_index, detail, params_list):
+    # lut_index: (H, W, 3) int32 indices into a flattened (3 * LUT_SIZE) table,
+    # detail: (H, W, 3) float32 high-pass of the source in 0..255 units.
+    # Returns (N, H, W, 3) uint8.
+    import numpy as np
+
+    luts = compile_color_luts(params_list) * 255.0 + 0.5
+    luts = luts.reshape(len(params_list), -1)
+
+    # Colour transform: one table lookup per pixel and channel for every variant
+    result = np.take(luts, lut_index, axis=1)
+    # Unsharp mask; the high-pass detail is taken from the source once for all variants
+    scaled_detail = np.empty_like(detail)
+    for variant_pixels, params in zip(result, params_list):
+        np.multiply(detail, params["sharpen"], out=scaled_detail)
+        variant_pixels += scaled_detail
+    np.clip(result, 0.0, 255.0, out=result)
+    return result.astype(np.uint8)
+
+def _build_exif_bytes(source_exif, comment):
+    import piexif
+
+    exif_dict = {"0th": {}, "Exif": {}, "GPS": {}, "Interop": {}, "1st": {}, "thumbnail": None}
+    if source_exif:
+        try:
+            exif_dict = piexif.load(source_exif)
+        except Exception as e:
+            logger.warning("Could not parse source EXIF, writing a fresh block: %s", e)
+    # Thumbnails of the original no longer match the variant
+    exif_dict["1st"] = {}
+    exif_dict["thumbnail"] = None
+    exif_dict["0th"][piexif.ImageIFD.ImageDescription] = comment.encode("utf-8")
+    try:
+        return piexif.dump(exif_dict)
+    except Exception as e:
+        logger.warning("Could not re-encode source EXIF, writing a fresh block: %s", e)
+        return piexif.dump({"0th": {piexif.ImageIFD.ImageDescription: comment.encode("utf-8")}})
+
+def _save_photo(pixels, output_path, params, source_exif):
+    from PIL import Image
+    from PIL.PngImagePlugin import PngInfo
+
+    image_format = PHOTO_FAST_PATH_FORMATS[os.path.splitext(output_path)[1].lower()]
+    comment = build_comment_metadata(params)
+    image = Image.fromarray(pixels, mode="RGB")
+    if image_format == "JPEG":
+        image.save(
+            output_path,
+            "JPEG",
+            quality=PHOTO_JPEG_QUALITY,
+            exif=_build_exif_bytes(source_exif, comment),
+        )
+    else:
+        png_info = PngInfo()
+        png_info.add_text("Description", comment)
+        image.save(output_path, "PNG", pnginfo=png_info, compress_level=PHOTO_PNG_COMPRESS_LEVEL)
+
+def process_photo_variants(input_path, outputs, max_side=None):
+    # Decode the photo once and render every variant with NumPy, writing
+    # the comment metadata directly (EXIF for JPEG, tEXt for PNG).
+    # max_side downscales the source first (used for previews).
+    if not outputs:
+        return
+
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(input_path) as image:
+        source_exif = image.info.get("exif")
+        image = image.convert("RGB")
+        if max_side:
+            image.thumbnail((max_side, max_side))
+        pixels = np.asarray(image, dtype=np.uint8)
+
+    # Matches the 5x5 kernel of "unsharp=5:5"
+    source = pixels.astype(np.float32)
+    detail = source - _box_blur(source, 2)
+    del source
+    # Offset each channel into its own slice of the flattened per-variant table
+    lut_index = pixels.astype(np.int32) + np.arange(3, dtype=np.int32) * LUT_SIZE
+
+    batch_size = max(1, PHOTO_BATCH_ELEMENTS // pixels.size)
+    for start in range(0, len(outputs), batch_size):
+        batch = outputs[start:start + batch_size]
+        rendered = _render_photo_batch(lut_index, detail, [params for _, params in batch])
+        for (output_path, params), variant_pixels in zip(batch, rendered):
+            _save_photo(variant_pixels, output_path, params, source_exif)
+
+    logger.info("Rendered %d photo variant(s) in-process: %s", len(outputs), ", ".join(output_path for output_path, _ in outputs))
+
+# Metadata-only variants: new comment, untouched audio/video/image data
+
+def build_remux_command(input_path, outputs):
+    # Stream-copy the input into every output in one process; only the comment differs
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-i", input_path,
+    ]
+    for output_path, params in outputs:
+        cmd += [
+            "-map", "0:v",
+            "-map", "0:a?",
+            "-c", "copy",
+            "-map_metadata", "0",
+            "-metadata", f"comment={build_comment_metadata(params)}",
+            output_path,
+        ]
+    return cmd
+
+async def remux_metadata_variants_async(input_path, outputs):
+    if not outputs:
+        return
+
+    cmd = build_remux_command(input_path, outputs)
+    await run_ffmpeg(cmd, label=f"{os.path.basename(input_path)} remux x{len(outputs)}")
+    logger.info("Metadata-only remux successful: %s", ", ".join(output_path for output_path, _ in outputs))
+
+def _png_chunk(chunk_type, data):
+    return (
+        struct.pack(">I", len(data)) + chunk_type + data
+        + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF)
+    )
+
+def _png_with_description(png_bytes, comment):
+    # Copy every chunk as-is, replacing any Description text with ours before the first IDAT
+    text_chunk = _png_chunk(b"tEXt", b"Description\x00" + comment.encode("latin-1", errors="replace"))
+    parts = [png_bytes[:8]]
+    position = 8
+    inserted = False
+    while position + 8 <= len(png_bytes):
+        length, chunk_type = struct.unpack(">I4s", png_bytes[position:position + 8])
+        chunk_end = position + 12 + length
+        data = png_bytes[position + 8:position + 8 + length]
+        is_description = (
+            chunk_type in (b"tEXt", b"zTXt", b"iTXt")
+            and data.partition(b"\x00")[0] == b"Description"
+        )
+        if chunk_type in (b"IDAT", b"IEND") and not inserted:
+            parts.append(text_chunk)
+            inserted = True
+        if not is_description:
+            parts.append(png_bytes[position:chunk_end])
+        position = chunk_end
+    return b"".join(parts)
+
+def rewrite_photo_metadata_variants(input_path, outputs):
+    # Lossless metadata rewrite: the compressed image data is copied byte for byte
+    if not outputs:
+        return
+
+    import piexif
+    from PIL import Image
+
+    with open(input_path, "rb") as f:
+        source_bytes = f.read()
+    image_format = PHOTO_FAST_PATH_FORMATS[os.path.splitext(input_path)[1].lower()]
+
+    source_exif = None
+    if image_format == "JPEG":
+        with Image.open(input_path) as image:
+            source_exif = image.info.get("exif")
+
+    for output_path, params in outputs:
+        comment = build_comment_metadata(params)
+        if image_format == "JPEG":
+            piexif.insert(_build_exif_bytes(source_exif, comment), source_bytes, output_path)
+        else:
+            with open(output_path, "wb") as f:
+                f.write(_png_with_description(source_bytes, comment))
+
+    logger.info("Rewrote metadata for %d photo variant(s): %s", len(outputs), ", ".join(output_path for output_path, _ in outputs))
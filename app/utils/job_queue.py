@@ -0,0 +1,311 @@
+# app/utils/job_queue.py
+
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import asyncio
+import logging
+import threading
+
+from app.config import (
+    JOB_QUEUE_PATH,
+    JOB_WORKERS,
+    JOB_POLL_INTERVAL,
+    JOB_RETENTION_SECONDS,
+    JOB_LEASE_SECONDS,
+    JOB_HEARTBEAT_INTERVAL,
+)
+from app.utils.metrics import JOBS, time_stage
+
+logger = logging.getLogger("metaOfmBot")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    error TEXT,
+    result TEXT,
+    owner TEXT,
+    lease_expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status_user ON jobs (status, user_id, id);
+"""
+
+class PersistentJobQueue:
+    # SQLite-backed job queue. Jobs survive restarts; workers pull them with
+    # round-robin scheduling across users so one user cannot starve the rest.
+    # Several processes (uvicorn workers) may share the file: a claimed job
+    # carries its process's owner id and a lease that a heartbeat keeps
+    # renewing, and only jobs whose lease expired are taken back.
+
+    def __init__(self, path, workers):
+        self.path = path
+        self.workers = workers
+        # Unique per process start, so a restarted process does not pass for its predecessor
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._conn = None
+        self._wakeup = None
+        self._tasks = []
+        self._last_user_id = None
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.executescript(SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, definition in (("result", "TEXT"), ("owner", "TEXT"), ("lease_expires_at", "REAL")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+            self._conn = conn
+        return self._conn
+
+    def enqueue(self, user_id, payload):
+        with self._lock:
+            conn = self._connect()
+            cursor = conn.execute(
+                "INSERT INTO jobs (user_id, payload, created_at) VALUES (?, ?, ?)",
+                (user_id, json.dumps(payload), time.time()),
+            )
+            job_id = cursor.lastrowid
+        if self._wakeup is not None:
+            self._wakeup.set()
+        logger.info("Enqueued job %s for user %s", job_id, user_id)
+        return job_id, self.position(job_id)
+
+    def position(self, job_id):
+        # Estimated 1-based position under round-robin scheduling: the user's
+        # own earlier jobs, plus up to that many jobs from every other user.
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT user_id FROM jobs WHERE id = ? AND status = 'queued'", (job_id,)
+            ).fetchone()
+            if row is None:
+                return 0
+            user_id = row[0]
+            own_rank = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND user_id = ? AND id <= ?",
+                (user_id, job_id),
+            ).fetchone()[0]
+            others = conn.execute(
+                "SELECT user_id, COUNT(*) FROM jobs WHERE status = 'queued' AND user_id != ? "
+                "GROUP BY user_id",
+                (user_id,),
+            ).fetchall()
+        return own_rank + sum(min(count, own_rank) for _, count in others)
+
+    def get_job(self, job_id):
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT user_id, payload, status, result FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        user_id, payload, status, result = row
+        return {
+            "id": job_id,
+            "user_id": user_id,
+            "payload": json.loads(payload),
+            "status": status,
+            "result": json.loads(result) if result else None,
+        }
+
+    def set_result(self, job_id, result):
+        # Data a finished job leaves for follow-up actions (e.g. preview params)
+        with self._lock:
+            conn = self._connect()
+            conn.execute("UPDATE jobs SET result = ? WHERE id = ?", (json.dumps(result), job_id))
+
+    def pending_count(self):
+        with self._lock:
+            conn = self._connect()
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def running_count(self):
+        with self._lock:
+            conn = self._connect()
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'running'").fetchone()[0]
+
+    def _claim_next(self):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                heads = conn.execute(
+                    "SELECT user_id, MIN(id) FROM jobs WHERE status = 'queued' "
+                    "GROUP BY user_id ORDER BY user_id"
+                ).fetchall()
+                if not heads:
+                    conn.execute("COMMIT")
+                    return None
+                busy = {
+                    row[0] for row in conn.execute(
+                        "SELECT DISTINCT user_id FROM jobs WHERE status = 'running'"
+                    )
+                }
+                # Prefer users who have nothing running right now
+                candidates = [head for head in heads if head[0] not in busy] or heads
+                chosen = candidates[0]
+                if self._last_user_id is not None:
+                    for head in candidates:
+                        if head[0] > self._last_user_id:
+                            chosen = head
+                            break
+                user_id, job_id = chosen
+                now = time.time()
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', started_at = ?, owner = ?, lease_expires_at = ? "
+                    "WHERE id = ?",
+                    (now, self.owner, now + JOB_LEASE_SECONDS, job_id),
+                )
+                payload = conn.execute("SELECT payload FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self._last_user_id = user_id
+        return {"id": job_id, "user_id": user_id, "payload": json.loads(payload)}
+
+    def _finish(self, job_id, status, error=None):
+        # Only while the job is still ours: after a lost lease another process owns it
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, error = ?, lease_expires_at = NULL "
+                "WHERE id = ? AND owner = ?",
+                (status, time.time(), error, job_id, self.owner),
+            )
+
+    def _renew_leases(self):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "UPDATE jobs SET lease_expires_at = ? WHERE status = 'running' AND owner = ?",
+                (time.time() + JOB_LEASE_SECONDS, self.owner),
+            )
+
+    def _recover(self):
+        # Jobs whose process died (lease expired, or no lease from before
+        # leases existed) go back to the queue
+        with self._lock:
+            conn = self._connect()
+            requeued = conn.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL, owner = NULL, lease_expires_at = NULL "
+                "WHERE status = 'running' AND (lease_expires_at IS NULL OR lease_expires_at < ?)",
+                (time.time(),),
+            ).rowcount
+            purged = conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+                (time.time() - JOB_RETENTION_SECONDS,),
+            ).rowcount
+        if requeued:
+            logger.warning("Re-queued %s interrupted job(s)", requeued)
+            if self._wakeup is not None:
+                self._wakeup.set()
+        if purged:
+            logger.info("Purged %s finished job(s) from the queue", purged)
+
+    def _release_own(self):
+        # On shutdown our interrupted jobs can be picked up right away
+        with self._lock:
+            conn = self._connect()
+            released = conn.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL, owner = NULL, lease_expires_at = NULL "
+                "WHERE status = 'running' AND owner = ?",
+                (self.owner,),
+            ).rowcount
+        if released:
+            logger.info("Released %s interrupted job(s) back to the queue", released)
+
+    async def _heartbeat(self):
+        # Keep our leases alive and take back jobs of processes that died
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+            try:
+                self._renew_leases()
+                self._recover()
+            except sqlite3.Error as e:
+                logger.warning("Job queue heartbeat failed: %s", e)
+
+    async def _finish_with_retry(self, job_id, status, error=None):
+        # A busy database must not leave a finished job running until its lease expires
+        for attempt in range(1, 4):
+            try:
+                self._finish(job_id, status, error)
+                return
+            except sqlite3.OperationalError as e:
+                logger.warning("Could not mark job %s as %s (attempt %d): %s", job_id, status, attempt, e)
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+        logger.error("Giving up marking job %s as %s; it is re-queued once its lease expires", job_id, status)
+
+    async def _worker(self, worker_id, handler):
+        while True:
+            self._wakeup.clear()
+            try:
+                job = self._claim_next()
+            except sqlite3.OperationalError as e:
+                # e.g. "database is locked" past busy_timeout; try again on the next poll
+                logger.warning("Worker %s could not claim a job: %s", worker_id, e)
+                job = None
+            if job is None:
+                # Not wait_for(): on Python 3.11 it swallows a cancel that
+                # arrives as the wakeup fires, and stop() would wait forever
+                try:
+                    async with asyncio.timeout(JOB_POLL_INTERVAL):
+                        await self._wakeup.wait()
+                except TimeoutError:
+                    pass
+                continue
+
+            logger.info("Worker %s started job %s for user %s", worker_id, job["id"], job["user_id"])
+            mode = job["payload"].get("mode", "full")
+            file_type = job["payload"].get("file_type", "album" if job["payload"].get("items") else "unknown")
+            try:
+                with time_stage("job", file_type):
+                    await handler(job)
+            except asyncio.CancelledError:
+                # Leave the job as running; stop() releases it back to the queue
+                raise
+            except Exception as e:
+                logger.error("Job %s failed: %s", job["id"], e, exc_info=True)
+                await self._finish_with_retry(job["id"], "failed", str(e))
+                JOBS.inc(mode=mode, file_type=file_type, status="failed")
+            else:
+                await self._finish_with_retry(job["id"], "done")
+                JOBS.inc(mode=mode, file_type=file_type, status="done")
+                logger.info("Worker %s finished job %s", worker_id, job["id"])
+
+    async def start(self, handler):
+        self._recover()
+        self._wakeup = asyncio.Event()
+        self._tasks = [
+            asyncio.create_task(self._worker(worker_id, handler))
+            for worker_id in range(1, self.workers + 1)
+        ]
+        self._tasks.append(asyncio.create_task(self._heartbeat()))
+        logger.info("Job queue started with %s worker(s), %s job(s) pending", self.workers, self.pending_count())
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._release_own()
+        logger.info("Job queue stopped")
+
+job_queue = PersistentJobQueue(JOB_QUEUE_PATH, JOB_WORKERS)
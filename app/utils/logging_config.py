@@ -1,18 +1,60 @@
 # app/utils/logging_config.py
 
+import json
+import queue
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
-
-# Configure logging with RotatingFileHandler to prevent log files from growing indefinitely
-handler = RotatingFileHandler("app/bot.log", maxBytes=5*1024*1024, backupCount=5)
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-    handlers=[
-        handler,
-        logging.StreamHandler()
-    ]
-)
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+from app.config import LOG_LEVEL, LOG_FORMAT
+
+# Standard LogRecord attributes; anything else on a record came from `extra=`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line; fields passed via extra= are kept as keys
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DeferredQueueHandler(QueueHandler):
+    # The stock QueueHandler formats the message in the calling thread. Here
+    # the record is queued as-is and the listener thread does the %-formatting
+    # and JSON encoding, so a log call on the event loop costs one queue put.
+    # Log arguments must therefore not be mutated after the call.
+
+    def prepare(self, record):
+        return record
+
+def _build_formatter():
+    if LOG_FORMAT == "json":
+        return JsonFormatter()
+    return logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+# Disk and console writes happen on the listener's background thread;
+# RotatingFileHandler still keeps the log files from growing indefinitely
+formatter = _build_formatter()
+file_handler = RotatingFileHandler("app/bot.log", maxBytes=5*1024*1024, backupCount=5)
+file_handler.setFormatter(formatter)
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+
+log_queue = queue.SimpleQueue()
+listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+logging.basicConfig(level=LOG_LEVEL, handlers=[DeferredQueueHandler(log_queue)])
+listener.start()
+# Flush whatever is still queued on interpreter exit
+atexit.register(listener.stop)
 
 # Create a logger for the bot
 logger = logging.getLogger("metaOfmBot")  # Use a consistent logger name
@@ -1,19 +1,24 @@
 import os
 import hashlib
+import re
+import struct
 import json
-from PIL import Image
-import piexif
-from pymediainfo import MediaInfo
+import threading
+from collections import OrderedDict
 import logging
 
+from app.config import METADATA_CACHE_SIZE
+from app.utils.metadata_reader import read_metadata_fast, read_mp4_duration
+
 logger = logging.getLogger(__name__)
 
-def get_metadata(file_path, file_type):
-    if not os.path.isfile(file_path):
-        logger.warning(f"get_metadata: File not found: {file_path}")
-        return {}
+# MediaInfo, piexif and Pillow are only needed when the header-only readers
+# cannot answer, so they are imported on first use rather than at startup.
+
+def _parse_metadata_full(file_path, file_type):
     metadata_dict = {}
     if file_type == "video":
+        from pymediainfo import MediaInfo
         media_info = MediaInfo.parse(file_path)
         for track in media_info.tracks:
             if track.track_type == "General":
@@ -24,6 +29,7 @@ def get_metadata(file_path, file_type):
     elif file_type == "photo":
         ext = os.path.splitext(file_path)[1].lower()
         if ext in [".jpg", ".jpeg", ".tiff"]:
+            import piexif
             try:
                 exif_dict = piexif.load(file_path)
                 if "0th" in exif_dict:
@@ -32,8 +38,9 @@ def get_metadata(file_path, file_type):
                     if piexif.ImageIFD.ImageDescription in exif_dict["0th"]:
                         metadata_dict["comment"] = exif_dict["0th"][piexif.ImageIFD.ImageDescription].decode(errors="ignore")
             except piexif.InvalidImageDataError:
-                logger.warning(f"No EXIF data found for {file_path}.")
+                logger.warning("No EXIF data found for %s.", file_path)
         elif ext == ".png":
+            from PIL import Image
             try:
                 image = Image.open(file_path)
                 info = image.info
@@ -42,32 +49,81 @@ def get_metadata(file_path, file_type):
                 if 'Description' in info:
                     metadata_dict["comment"] = info['Description']
             except Exception as e:
-                logger.error(f"PNG metadata extraction failed: {e}")
+                logger.error("PNG metadata extraction failed: %s", e)
     return metadata_dict
 
+_metadata_cache = OrderedDict()
+_metadata_cache_lock = threading.Lock()
+
+def _metadata_cache_key(file_path, file_type, content_hash):
+    if content_hash:
+        return (content_hash, file_type)
+    stat = os.stat(file_path)
+    return (os.path.realpath(file_path), stat.st_size, stat.st_mtime_ns, file_type)
+
+def get_metadata(file_path, file_type, content_hash=None):
+    if not os.path.isfile(file_path):
+        logger.warning("get_metadata: File not found: %s", file_path)
+        return {}
+
+    cache_key = _metadata_cache_key(file_path, file_type, content_hash)
+    with _metadata_cache_lock:
+        if cache_key in _metadata_cache:
+            _metadata_cache.move_to_end(cache_key)
+            return dict(_metadata_cache[cache_key])
+
+    ext = os.path.splitext(file_path)[1].lower()
+    with open(file_path, "rb") as f:
+        metadata_dict = read_metadata_fast(f, file_type, ext)
+    if metadata_dict is None:
+        # Exotic container: fall back to MediaInfo / piexif / Pillow
+        metadata_dict = _parse_metadata_full(file_path, file_type)
+
+    with _metadata_cache_lock:
+        _metadata_cache[cache_key] = dict(metadata_dict)
+        if len(_metadata_cache) > METADATA_CACHE_SIZE:
+            _metadata_cache.popitem(last=False)
+    return metadata_dict
+
+# Keys in our comment that differ from the PARAMETERS names
+COMMENT_KEY_ALIASES = {
+    "temperature": "temp",
+}
+
+def _parse_comment_params(comment):
+    # Comments are written as "Key=value; Key=value" (older ones used ", ")
+    params = {}
+    for part in re.split(r"[;,]\s*", comment):
+        key, sep, value = part.partition("=")
+        if not sep:
+            continue
+        key = key.strip().lower()
+        params[COMMENT_KEY_ALIASES.get(key, key)] = value.strip()
+    return params
+
+def get_video_duration(file_path):
+    # Duration in seconds: MP4/MOV header first, MediaInfo for other containers
+    try:
+        with open(file_path, "rb") as f:
+            duration = read_mp4_duration(f)
+        if duration:
+            return duration
+    except (OSError, struct.error, IndexError) as e:
+        logger.warning("Could not read MP4 duration from %s: %s", file_path, e)
+    try:
+        from pymediainfo import MediaInfo
+        for track in MediaInfo.parse(file_path).tracks:
+            if track.track_type == "General" and track.duration:
+                return float(track.duration) / 1000.0
+    except Exception as e:
+        logger.warning("Could not read duration with MediaInfo from %s: %s", file_path, e)
+    return None
+
 def compare_metadata(original_meta, updated_meta, parameters):
     fields = list(parameters.keys()) + ["title", "comment"]
     lines = []
-    original_params = {}
-    updated_params = {}
-
-    if "comment" in original_meta:
-        try:
-            parts = original_meta["comment"].split(", ")
-            for part in parts:
-                key, value = part.split("=")
-                original_params[key.lower()] = value
-        except:
-            pass
-
-    if "comment" in updated_meta:
-        try:
-            parts = updated_meta["comment"].split(", ")
-            for part in parts:
-                key, value = part.split("=")
-                updated_params[key.lower()] = value
-        except:
-            pass
+    original_params = _parse_comment_params(original_meta.get("comment", ""))
+    updated_params = _parse_comment_params(updated_meta.get("comment", ""))
 
     for field in parameters.keys():
         orig_val = original_params.get(field, "N/A")
@@ -0,0 +1,235 @@
+# app/utils/metadata_reader.py
+
+import struct
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Header-only readers for the title/comment tags we care about. Each reader
+# takes a seekable binary file object, reads only the boxes/segments/chunks
+# it needs and skips everything else with seek(). A reader returns None when
+# the container is not what it expected, so callers can fall back to a full
+# parser.
+
+# ---------------------------------------------------------------- MP4 / MOV
+
+MP4_TOP_LEVEL_BOXES = {b"ftyp", b"moov", b"mdat", b"free", b"skip", b"wide", b"uuid", b"pdin", b"moof", b"mfra", b"meta"}
+MP4_TAGS = {
+    b"\xa9cmt": "comment",
+    b"\xa9nam": "title",
+}
+
+def _iter_boxes(f, start, end):
+    position = start
+    while position + 8 <= end:
+        f.seek(position)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack(">I4s", header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - position
+        if size < header_size or position + size > end:
+            return
+        yield box_type, position + header_size, position + size
+        position += size
+
+def _find_box(f, start, end, box_type):
+    for child_type, child_start, child_end in _iter_boxes(f, start, end):
+        if child_type == box_type:
+            return child_start, child_end
+    return None
+
+def _read_ilst(f, start, end, metadata):
+    for item_type, item_start, item_end in _iter_boxes(f, start, end):
+        key = MP4_TAGS.get(item_type)
+        if key is None:
+            continue
+        data_box = _find_box(f, item_start, item_end, b"data")
+        if data_box is None:
+            continue
+        data_start, data_end = data_box
+        # 4 bytes type indicator + 4 bytes locale precede the value
+        f.seek(data_start + 8)
+        metadata[key] = f.read(data_end - data_start - 8).decode("utf-8", errors="ignore")
+
+def _read_udta(f, start, end, metadata):
+    for box_type, box_start, box_end in _iter_boxes(f, start, end):
+        if box_type == b"meta":
+            # ISO "meta" is a full box (4 bytes version/flags); QuickTime's is not
+            f.seek(box_start + 8)
+            offset = 4 if f.read(4) == b"hdlr" else 0
+            ilst = _find_box(f, box_start + offset, box_end, b"ilst")
+            if ilst is not None:
+                _read_ilst(f, ilst[0], ilst[1], metadata)
+        elif box_type in MP4_TAGS and MP4_TAGS[box_type] not in metadata:
+            # QuickTime user data text: 2 bytes length + 2 bytes language
+            f.seek(box_start)
+            length, _ = struct.unpack(">HH", f.read(4))
+            metadata[MP4_TAGS[box_type]] = f.read(length).decode("utf-8", errors="ignore")
+
+def read_mp4_metadata(f):
+    f.seek(0, 2)
+    file_end = f.tell()
+    f.seek(4)
+    if f.read(4) not in MP4_TOP_LEVEL_BOXES:
+        return None
+    moov = _find_box(f, 0, file_end, b"moov")
+    if moov is None:
+        return None
+    metadata = {}
+    udta = _find_box(f, moov[0], moov[1], b"udta")
+    if udta is not None:
+        _read_udta(f, udta[0], udta[1], metadata)
+    return metadata
+
+def read_mp4_duration(f):
+    # Movie duration in seconds from moov/mvhd, or None
+    f.seek(0, 2)
+    file_end = f.tell()
+    f.seek(4)
+    if f.read(4) not in MP4_TOP_LEVEL_BOXES:
+        return None
+    moov = _find_box(f, 0, file_end, b"moov")
+    if moov is None:
+        return None
+    mvhd = _find_box(f, moov[0], moov[1], b"mvhd")
+    if mvhd is None:
+        return None
+    f.seek(mvhd[0])
+    version = f.read(4)[0]
+    if version == 1:
+        # creation/modification times are 64-bit in version 1
+        f.seek(16, 1)
+        timescale, duration = struct.unpack(">IQ", f.read(12))
+    else:
+        f.seek(8, 1)
+        timescale, duration = struct.unpack(">II", f.read(8))
+    if not timescale:
+        return None
+    return duration / timescale
+
+# ---------------------------------------------------------------- JPEG
+
+EXIF_TAGS = {
+    0x010E: "comment",  # ImageDescription
+    0x013B: "title",  # Artist
+}
+TIFF_ASCII = 2
+
+def _read_tiff_ifd0(tiff):
+    if tiff[:2] == b"II":
+        endian = "<"
+    elif tiff[:2] == b"MM":
+        endian = ">"
+    else:
+        return {}
+    ifd_offset = struct.unpack(endian + "I", tiff[4:8])[0]
+    if ifd_offset + 2 > len(tiff):
+        return {}
+    entry_count = struct.unpack(endian + "H", tiff[ifd_offset:ifd_offset + 2])[0]
+    metadata = {}
+    for index in range(entry_count):
+        entry_start = ifd_offset + 2 + index * 12
+        entry = tiff[entry_start:entry_start + 12]
+        if len(entry) < 12:
+            break
+        tag, value_type, count = struct.unpack(endian + "HHI", entry[:8])
+        key = EXIF_TAGS.get(tag)
+        if key is None or value_type != TIFF_ASCII:
+            continue
+        if count <= 4:
+            raw = entry[8:8 + count]
+        else:
+            value_offset = struct.unpack(endian + "I", entry[8:12])[0]
+            raw = tiff[value_offset:value_offset + count]
+        metadata[key] = raw.rstrip(b"\x00").decode(errors="ignore")
+    return metadata
+
+def read_jpeg_metadata(f):
+    f.seek(0)
+    if f.read(2) != b"\xff\xd8":
+        return None
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return {}
+        code = marker[1]
+        while code == 0xFF:
+            # Fill bytes before a marker
+            code = f.read(1)[0]
+        if code in (0xD9, 0xDA):
+            # End of image / start of scan: no more metadata segments
+            return {}
+        if 0xD0 <= code <= 0xD7 or code == 0x01:
+            continue
+        length = struct.unpack(">H", f.read(2))[0]
+        if code == 0xE1:
+            segment = f.read(length - 2)
+            if segment.startswith(b"Exif\x00\x00"):
+                return _read_tiff_ifd0(segment[6:])
+        else:
+            f.seek(length - 2, 1)
+
+# ---------------------------------------------------------------- PNG
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_TEXT_KEYS = {
+    "Title": "title",
+    "Description": "comment",
+}
+
+def _decode_png_text(chunk_type, data):
+    keyword, _, rest = data.partition(b"\x00")
+    keyword = keyword.decode("latin-1")
+    if chunk_type == b"tEXt":
+        return keyword, rest.decode("latin-1")
+    if chunk_type == b"zTXt":
+        return keyword, zlib.decompress(rest[1:]).decode("latin-1")
+    # iTXt: compression flag, method, language tag, translated keyword, text
+    compressed, rest = rest[0], rest[2:]
+    _, _, rest = rest.partition(b"\x00")
+    _, _, text = rest.partition(b"\x00")
+    if compressed:
+        text = zlib.decompress(text)
+    return keyword, text.decode("utf-8", errors="ignore")
+
+def read_png_metadata(f):
+    f.seek(0)
+    if f.read(8) != PNG_SIGNATURE:
+        return None
+    metadata = {}
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return metadata
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type == b"IEND":
+            return metadata
+        if chunk_type in (b"tEXt", b"zTXt", b"iTXt"):
+            keyword, text = _decode_png_text(chunk_type, f.read(length))
+            if keyword in PNG_TEXT_KEYS:
+                metadata[PNG_TEXT_KEYS[keyword]] = text
+            f.seek(4, 1)  # CRC
+        else:
+            f.seek(length + 4, 1)
+
+# ---------------------------------------------------------------- dispatch
+
+def read_metadata_fast(f, file_type, ext):
+    # Returns the title/comment dict, or None if the container needs a full parser
+    try:
+        if file_type == "video" and ext in (".mp4", ".m4v", ".mov", ".3gp"):
+            return read_mp4_metadata(f)
+        if file_type == "photo" and ext in (".jpg", ".jpeg"):
+            return read_jpeg_metadata(f)
+        if file_type == "photo" and ext == ".png":
+            return read_png_metadata(f)
+    except (struct.error, IndexError, ValueError, zlib.error) as e:
+        logger.warning("Header-only metadata read failed, falling back to a full parse: %s", e)
+    return None
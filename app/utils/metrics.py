@@ -0,0 +1,209 @@
+# app/utils/metrics.py
+
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Minimal in-process metrics rendered in the Prometheus text exposition
+# format. Counters and histograms are updated from the event loop and from
+# worker threads (asyncio.to_thread), so every update takes the metric lock.
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+class Gauge(_Metric):
+    # A gauge is either set explicitly or read from a callback at scrape time
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_callback(self, callback):
+        self.callback = callback
+
+    def render(self):
+        if self.callback is not None:
+            try:
+                return [f"{self.name} {_format_value(self.callback())}"]
+            except Exception:
+                return []
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (not cumulative), count, sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += 1
+            state[2] += value
+
+    def snapshot(self):
+        # {label values: (count, sum)}, e.g. for before/after comparisons
+        with self._lock:
+            return {key: (state[1], state[2]) for key, state in self._values.items()}
+
+    def render(self):
+        with self._lock:
+            items = sorted((key, [list(state[0]), state[1], state[2]]) for key, state in self._values.items())
+        lines = []
+        for key, (counts, count, total) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_count{labels} {count}")
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), callback=None):
+        return self._register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STAGE_SECONDS = metrics.histogram(
+    "bot_stage_duration_seconds",
+    "Time spent in each processing stage.",
+    ("stage", "file_type"),
+)
+STAGE_ERRORS = metrics.counter(
+    "bot_stage_errors_total",
+    "Processing stages that raised an exception.",
+    ("stage", "file_type"),
+)
+JOBS = metrics.counter(
+    "bot_jobs_total",
+    "Jobs finished by the queue workers, by mode and outcome.",
+    ("mode", "file_type", "status"),
+)
+BYTES_PROCESSED = metrics.counter(
+    "bot_bytes_processed_total",
+    "Bytes downloaded from and uploaded to Telegram.",
+    ("direction", "file_type"),
+)
+QUEUE_DEPTH = metrics.gauge("bot_job_queue_depth", "Jobs waiting in the persistent queue.")
+JOBS_RUNNING = metrics.gauge("bot_jobs_running", "Jobs currently being processed.")
+FFMPEG_ACTIVE = metrics.gauge("bot_ffmpeg_active_processes", "FFmpeg processes currently running.")
+STARTUP_SECONDS = metrics.gauge(
+    "bot_startup_seconds",
+    "Cold-start timing: module imports, lifespan startup and the background index load.",
+    ("phase",),
+)
+FFMPEG_FPS = metrics.histogram(
+    "bot_ffmpeg_encode_fps",
+    "Encode speed in frames per second, sampled from FFmpeg -progress output.",
+    buckets=(1, 5, 10, 25, 50, 100, 200, 400, 800),
+)
+OUTPUT_CACHE_LOOKUPS = metrics.counter(
+    "bot_output_cache_lookups_total",
+    "Variants served by Telegram file_id, from a cached file, or rendered (miss).",
+    ("result", "file_type"),
+)
+NEAR_DUPLICATES = metrics.counter(
+    "bot_variant_near_duplicates_total",
+    "Variants that looked too similar to another variant, re-rendered with new parameters or dropped.",
+    ("outcome", "file_type"),
+)
+
+@contextmanager
+def time_stage(stage, file_type="unknown"):
+    # Usable around awaits too: only wall-clock time is measured
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage, file_type=file_type)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage, file_type=file_type)
@@ -0,0 +1,228 @@
+# app/utils/output_cache.py
+
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+
+from app.config import OUTPUT_CACHE_PATH, OUTPUT_CACHE_DIR, OUTPUT_CACHE_MAX_MB, OUTPUT_CACHE_MAX_ENTRIES
+
+logger = logging.getLogger("metaOfmBot")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outputs (
+    key TEXT PRIMARY KEY,
+    input_hash TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    ext TEXT NOT NULL,
+    params TEXT NOT NULL,
+    file_type TEXT NOT NULL,
+    path TEXT,
+    size INTEGER NOT NULL DEFAULT 0,
+    telegram_file_id TEXT,
+    report TEXT,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_outputs_input ON outputs (input_hash, mode, ext, created_at);
+CREATE INDEX IF NOT EXISTS idx_outputs_last_used ON outputs (last_used);
+CREATE TABLE IF NOT EXISTS inputs (
+    file_unique_id TEXT PRIMARY KEY,
+    input_hash TEXT NOT NULL,
+    added_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_inputs_added_at ON inputs (added_at);
+"""
+
+def output_key(input_hash, mode, params, ext):
+    # Content address of a rendered variant: same input bytes, mode and
+    # parameters always produce an interchangeable output
+    canonical = json.dumps([input_hash, mode, ext.lower(), params], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class OutputCache:
+    # Rendered variants keyed by (input content hash, mode, parameters).
+    # Files are kept on disk within a size budget, least recently used
+    # first out; the Telegram file_id of a delivered variant outlives its
+    # file, so a repeat request is re-sent by file_id without any upload.
+    # Metadata lives in a WAL-mode SQLite file shared by all workers.
+
+    def __init__(self, path, directory, max_bytes, max_entries):
+        self.path = path
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _file_path(self, key, ext):
+        return os.path.join(self.directory, key[:2], key + ext)
+
+    def lookup(self, input_hash, mode, params, ext):
+        # {"path", "telegram_file_id", "report"} or None. path is None when
+        # the file was evicted and only the Telegram file_id is left.
+        key = output_key(input_hash, mode, params, ext)
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT path, telegram_file_id, report FROM outputs WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            path, telegram_file_id, report = row
+            if path is not None and not os.path.isfile(path):
+                path = None
+            if path is None and telegram_file_id is None:
+                return None
+            conn.execute("UPDATE outputs SET last_used = ? WHERE key = ?", (time.time(), key))
+        return {"path": path, "telegram_file_id": telegram_file_id, "report": report}
+
+    def put(self, input_hash, mode, params, source_path, file_type, report=None, keep_file=True):
+        # Store a rendered file in the cache; a file_id recorded earlier for
+        # the same key is kept. Without keep_file only the entry is written,
+        # to be served by the Telegram file_id once the variant is delivered.
+        ext = os.path.splitext(source_path)[1]
+        key = output_key(input_hash, mode, params, ext)
+        path = None
+        size = os.path.getsize(source_path) if keep_file else 0
+        if keep_file and size <= self.max_bytes:
+            path = self._file_path(key, ext)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            partial = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+            try:
+                # Rendered outputs are never rewritten in place, so a link is safe
+                os.link(source_path, partial)
+            except OSError:
+                # Workspace on another filesystem (tmpfs)
+                shutil.copyfile(source_path, partial)
+            os.replace(partial, path)
+        else:
+            size = 0
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "INSERT INTO outputs (key, input_hash, mode, ext, params, file_type, path, size, report, "
+                    "created_at, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET path = excluded.path, size = excluded.size, "
+                    "report = COALESCE(excluded.report, outputs.report), last_used = excluded.last_used",
+                    (key, input_hash, mode, ext.lower(), json.dumps(params), file_type, path, size, report, now, now),
+                )
+                removed = self._evict(conn)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        self._remove_files(removed)
+
+    def set_file_id(self, input_hash, mode, params, ext, telegram_file_id):
+        # None forgets a file_id Telegram no longer accepts
+        with self._lock:
+            self._connect().execute(
+                "UPDATE outputs SET telegram_file_id = ? WHERE key = ?",
+                (telegram_file_id, output_key(input_hash, mode, params, ext)),
+            )
+
+    def cached_params(self, input_hash, mode, ext):
+        # Parameters of the variants still servable for this input, oldest first
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT params FROM outputs WHERE input_hash = ? AND mode = ? AND ext = ? "
+                "AND (path IS NOT NULL OR telegram_file_id IS NOT NULL) ORDER BY created_at",
+                (input_hash, mode, ext.lower()),
+            ).fetchall()
+        return [json.loads(params) for params, in rows]
+
+    def has_outputs(self, input_hash):
+        with self._lock:
+            return self._connect().execute(
+                "SELECT 1 FROM outputs WHERE input_hash = ? "
+                "AND (path IS NOT NULL OR telegram_file_id IS NOT NULL) LIMIT 1",
+                (input_hash,),
+            ).fetchone() is not None
+
+    def remember_input(self, file_unique_id, input_hash):
+        # Telegram unique id -> content hash, so a re-upload can be answered
+        # from the cache before it is downloaded
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO inputs (file_unique_id, input_hash, added_at) VALUES (?, ?, ?)",
+                (file_unique_id, input_hash, time.time()),
+            )
+
+    def input_hash_for(self, file_unique_id):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT input_hash FROM inputs WHERE file_unique_id = ?", (file_unique_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def _evict(self, conn):
+        # Drop least recently used files past the disk budget (keeping rows
+        # that still have a file_id), then whole rows past max_entries.
+        # Returns the file paths to delete once the transaction is committed.
+        removed = []
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM outputs").fetchone()[0]
+        if total > self.max_bytes:
+            rows = conn.execute(
+                "SELECT key, path, size, telegram_file_id FROM outputs WHERE path IS NOT NULL ORDER BY last_used"
+            ).fetchall()
+            for key, path, size, telegram_file_id in rows:
+                if total <= self.max_bytes:
+                    break
+                if telegram_file_id is None:
+                    conn.execute("DELETE FROM outputs WHERE key = ?", (key,))
+                else:
+                    conn.execute("UPDATE outputs SET path = NULL, size = 0 WHERE key = ?", (key,))
+                removed.append(path)
+                total -= size
+        for key, path in conn.execute(
+            "SELECT key, path FROM outputs ORDER BY last_used DESC LIMIT -1 OFFSET ?", (self.max_entries,)
+        ).fetchall():
+            conn.execute("DELETE FROM outputs WHERE key = ?", (key,))
+            if path is not None:
+                removed.append(path)
+        conn.execute(
+            "DELETE FROM inputs WHERE file_unique_id NOT IN "
+            "(SELECT file_unique_id FROM inputs ORDER BY added_at DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+        if removed:
+            logger.info("Evicted %d cached output file(s)", len(removed))
+        return removed
+
+    @staticmethod
+    def _remove_files(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning("Could not remove cached output %s: %s", path, e)
+
+output_cache = OutputCache(
+    OUTPUT_CACHE_PATH,
+    OUTPUT_CACHE_DIR,
+    max_bytes=OUTPUT_CACHE_MAX_MB * 1024 * 1024,
+    max_entries=OUTPUT_CACHE_MAX_ENTRIES,
+)
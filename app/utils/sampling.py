@@ -0,0 +1,37 @@
+# app/utils/sampling.py
+
+import random
+
+# Low-discrepancy points for variant parameters. Independent uniform draws
+# clump: two variants of a job can land a few thousandths apart in every
+# parameter and look the same. Halton points fill the unit cube evenly, so
+# the variants of one job stay well apart; a random shift per job
+# (Cranley-Patterson rotation) keeps different jobs from repeating them.
+
+PRIMES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29)
+
+def radical_inverse(index, base):
+    # Digits of index in the given base, mirrored around the radix point
+    result = 0.0
+    scale = 1.0 / base
+    while index > 0:
+        index, digit = divmod(index, base)
+        result += digit * scale
+        scale /= base
+    return result
+
+class HaltonSampler:
+    def __init__(self, dimensions, rng=None):
+        if dimensions > len(PRIMES):
+            raise ValueError(f"HaltonSampler supports up to {len(PRIMES)} dimensions, got {dimensions}")
+        rng = rng or random
+        self.bases = PRIMES[:dimensions]
+        self.shift = [rng.random() for _ in self.bases]
+        # Index 0 is the origin in every dimension; start after it
+        self.index = 1
+
+    def next(self):
+        # Next point of the shifted sequence in [0, 1) ** dimensions
+        point = [(radical_inverse(self.index, base) + shift) % 1.0 for base, shift in zip(self.bases, self.shift)]
+        self.index += 1
+        return point
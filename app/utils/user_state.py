@@ -1,6 +1,246 @@
 # app/utils/user_state.py
 
-from typing import Dict
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
 
-# Shared USER_STATE dictionary
-USER_STATE: Dict[int, Dict[str, str]] = {}
+from app.config import USER_STATE_BACKEND, USER_STATE_PATH, USER_STATE_TTL_SECONDS, USER_STATE_MAX_ENTRIES
+
+logger = logging.getLogger("metaOfmBot")
+
+# Per-user pending upload (what /process will work on). Entries expire after
+# a TTL and the oldest are evicted past a size bound. Two backends share one
+# interface: get / set / update / modify / pop / delete, plus `in`.
+
+class MemoryStateStore:
+    # Process-local; fine for a single uvicorn worker
+
+    def __init__(self, ttl_seconds, max_entries):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id -> (expires_at, state), least recently set first
+
+    def _live(self, user_id, now):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] <= now:
+            del self._entries[user_id]
+            return None
+        return entry[1]
+
+    def _evict(self, now):
+        # With one TTL for everything, insertion order is expiry order
+        while self._entries:
+            expires_at, _ = next(iter(self._entries.values()))
+            if expires_at is None or expires_at > now:
+                break
+            self._entries.popitem(last=False)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, user_id):
+        with self._lock:
+            state = self._live(user_id, time.time())
+            return dict(state) if state is not None else None
+
+    def _store(self, user_id, state, now):
+        expires_at = now + self.ttl_seconds if self.ttl_seconds > 0 else None
+        self._entries.pop(user_id, None)
+        self._entries[user_id] = (expires_at, dict(state))
+        self._evict(now)
+
+    def set(self, user_id, state):
+        with self._lock:
+            self._store(user_id, state, time.time())
+
+    def update(self, user_id, **fields):
+        # Merge fields into an existing entry; returns False if there is none
+        with self._lock:
+            state = self._live(user_id, time.time())
+            if state is None:
+                return False
+            state.update(fields)
+            return True
+
+    def modify(self, user_id, change):
+        # Atomic read-modify-write: change(state or None) returns the new
+        # state, which is stored with a fresh TTL and returned
+        with self._lock:
+            now = time.time()
+            state = self._live(user_id, now)
+            state = change(dict(state) if state is not None else None)
+            self._store(user_id, state, now)
+        return state
+
+    def pop(self, user_id):
+        # Take the entry and remove it in one step
+        with self._lock:
+            state = self._live(user_id, time.time())
+            self._entries.pop(user_id, None)
+            return state
+
+    def delete(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __len__(self):
+        with self._lock:
+            self._evict(time.time())
+            return len(self._entries)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_state (
+    user_id INTEGER PRIMARY KEY,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_user_state_updated_at ON user_state (updated_at);
+"""
+
+class SQLiteStateStore:
+    # Shared through a WAL-mode SQLite file, so every uvicorn worker and the
+    # job workers see the same state, and it survives restarts.
+
+    # Sweep expired and excess rows after this many writes
+    PURGE_EVERY = 100
+
+    def __init__(self, path, ttl_seconds, max_entries):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = None
+        self._writes = 0
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _select(self, conn, user_id):
+        row = conn.execute(
+            "SELECT state FROM user_state WHERE user_id = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (user_id, time.time()),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _purge(self, conn):
+        removed = conn.execute(
+            "DELETE FROM user_state WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),)
+        ).rowcount
+        removed += conn.execute(
+            "DELETE FROM user_state WHERE user_id NOT IN "
+            "(SELECT user_id FROM user_state ORDER BY updated_at DESC LIMIT ?)",
+            (self.max_entries,),
+        ).rowcount
+        if removed:
+            logger.info("Evicted %d user state entr(ies)", removed)
+
+    def get(self, user_id):
+        with self._lock:
+            return self._select(self._connect(), user_id)
+
+    def _store(self, conn, user_id, state):
+        now = time.time()
+        expires_at = now + self.ttl_seconds if self.ttl_seconds > 0 else None
+        conn.execute(
+            "INSERT OR REPLACE INTO user_state (user_id, state, updated_at, expires_at) VALUES (?, ?, ?, ?)",
+            (user_id, json.dumps(state), now, expires_at),
+        )
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self._purge(conn)
+
+    def set(self, user_id, state):
+        with self._lock:
+            self._store(self._connect(), user_id, state)
+
+    def update(self, user_id, **fields):
+        # Merge fields into an existing entry; returns False if there is none
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                state = self._select(conn, user_id)
+                if state is not None:
+                    state.update(fields)
+                    conn.execute(
+                        "UPDATE user_state SET state = ? WHERE user_id = ?", (json.dumps(state), user_id)
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return state is not None
+
+    def modify(self, user_id, change):
+        # Atomic read-modify-write across processes: change(state or None)
+        # returns the new state, which is stored with a fresh TTL and returned
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                state = change(self._select(conn, user_id))
+                self._store(conn, user_id, state)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return state
+
+    def pop(self, user_id):
+        # Take the entry and remove it in one transaction, so two workers
+        # handling concurrent /process commands cannot both claim it
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                state = self._select(conn, user_id)
+                conn.execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return state
+
+    def delete(self, user_id):
+        with self._lock:
+            self._connect().execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __len__(self):
+        with self._lock:
+            conn = self._connect()
+            return conn.execute(
+                "SELECT COUNT(*) FROM user_state WHERE expires_at IS NULL OR expires_at > ?", (time.time(),)
+            ).fetchone()[0]
+
+def create_state_store(backend):
+    if backend == "memory":
+        return MemoryStateStore(USER_STATE_TTL_SECONDS, USER_STATE_MAX_ENTRIES)
+    if backend == "sqlite":
+        return SQLiteStateStore(USER_STATE_PATH, USER_STATE_TTL_SECONDS, USER_STATE_MAX_ENTRIES)
+    raise ValueError(f"Unknown USER_STATE_BACKEND: {backend}")
+
+# Shared user state
+user_state = create_state_store(USER_STATE_BACKEND)
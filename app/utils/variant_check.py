@@ -0,0 +1,121 @@
+# app/utils/variant_check.py
+
+import os
+import asyncio
+import logging
+
+from app.config import VARIANT_CHECK_FRAMES, VARIANT_CHECK_SIZE, VARIANT_MIN_DIFFERENCE
+from app.utils.encoder import capture_ffmpeg
+
+logger = logging.getLogger("metaOfmBot")
+
+# Near-duplicate check between the variants of a job. Every output is
+# reduced to a few small RGB thumbnails and all pairs are compared at once
+# by mean absolute difference in 8-bit levels. Perceptual hashes (pHash,
+# dHash) are built to ignore global tone and colour shifts, which is all
+# that separates our variants, so they would rate every pair identical;
+# plain thumbnails keep exactly that signal and cost about the same.
+# NumPy and Pillow are imported on first use, like in file_processing.
+
+def build_sample_command(path, duration, frames=VARIANT_CHECK_FRAMES, size=VARIANT_CHECK_SIZE):
+    # One input per sample, each seeked to the middle of its slice of the
+    # clip: FFmpeg jumps to the keyframe before the timestamp and decodes a
+    # single GOP, not the whole output. The first frame of every input is
+    # scaled to size x size and written to stdout as raw RGB.
+    timestamps = [duration * (k + 0.5) / frames for k in range(frames)] if duration else [0.0]
+    cmd = ["ffmpeg", "-v", "error"]
+    for timestamp in timestamps:
+        cmd += ["-ss", f"{timestamp:.3f}", "-i", path]
+    branches = [
+        f"[{k}:v:0]trim=end_frame=1,scale={size}:{size}:flags=area,setsar=1[f{k}]"
+        for k in range(len(timestamps))
+    ]
+    labels = "".join(f"[f{k}]" for k in range(len(timestamps)))
+    graph = ";".join(branches + [f"{labels}concat=n={len(timestamps)}:v=1:a=0[out]"])
+    return cmd + [
+        "-filter_complex", graph,
+        "-map", "[out]",
+        "-fps_mode", "passthrough",
+        "-frames:v", str(len(timestamps)),
+        "-f", "rawvideo",
+        "-pix_fmt", "rgb24",
+        "pipe:1",
+    ]
+
+async def sample_video(path, duration, frames=VARIANT_CHECK_FRAMES, size=VARIANT_CHECK_SIZE):
+    # (frames, size, size, 3) uint8; a single frame if the duration is unknown
+    import numpy as np
+
+    raw = await capture_ffmpeg(
+        build_sample_command(path, duration, frames, size), label=f"{os.path.basename(path)} thumbnails"
+    )
+    thumbnails = np.frombuffer(raw, dtype=np.uint8)
+    if thumbnails.size == 0 or thumbnails.size % (size * size * 3):
+        raise ValueError(f"FFmpeg returned {thumbnails.size} bytes of thumbnails for {path}")
+    return thumbnails.reshape(-1, size, size, 3)
+
+def sample_photo(path, size=VARIANT_CHECK_SIZE):
+    # (1, size, size, 3) uint8
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(path) as image:
+        # JPEG decodes straight at a fraction of the resolution
+        image.draft("RGB", (size * 8, size * 8))
+        thumbnail = image.convert("RGB").resize((size, size), Image.BOX)
+        return np.asarray(thumbnail, dtype=np.uint8)[None]
+
+def pairwise_differences(thumbnails):
+    # thumbnails: (N, frames, size, size, 3). Returns the (N, N) matrix of
+    # mean absolute differences between every pair, in one NumPy pass.
+    import numpy as np
+
+    flat = thumbnails.reshape(len(thumbnails), -1).astype(np.float32)
+    return np.abs(flat[:, None, :] - flat[None, :, :]).mean(axis=2)
+
+class VariantChecker:
+    # Keeps the thumbnails of the variants accepted so far in a job, so each
+    # rendered chunk is compared with all of them and with itself at once.
+
+    def __init__(self, file_type, duration=None, min_difference=VARIANT_MIN_DIFFERENCE):
+        self.file_type = file_type
+        self.duration = duration
+        self.min_difference = min_difference
+        self._accepted = None
+
+    async def _sample(self, paths):
+        import numpy as np
+
+        if self.file_type == "photo":
+            samples = await asyncio.gather(*(asyncio.to_thread(sample_photo, path) for path in paths))
+        else:
+            samples = await asyncio.gather(*(sample_video(path, self.duration) for path in paths))
+        # Outputs of one input yield the same frames; trim if a decoder stopped early
+        frames = min(len(sample) for sample in samples)
+        if self._accepted is not None:
+            frames = min(frames, self._accepted.shape[1])
+            self._accepted = self._accepted[:, :frames]
+        return np.stack([sample[:frames] for sample in samples])
+
+    async def check(self, paths):
+        # Distance of each new output to its nearest accepted variant (None
+        # for the very first one). Outputs at least min_difference away from
+        # everything accepted are accepted in order, the rest are not.
+        import numpy as np
+
+        thumbnails = await self._sample(paths)
+        if self._accepted is not None:
+            thumbnails = np.concatenate([self._accepted, thumbnails])
+        differences = pairwise_differences(thumbnails)
+        accepted = list(range(len(thumbnails) - len(paths)))
+        nearest = []
+        for row in range(len(accepted), len(thumbnails)):
+            distance = float(differences[row, accepted].min()) if accepted else None
+            if distance is None or distance >= self.min_difference:
+                accepted.append(row)
+            nearest.append(distance)
+        self._accepted = thumbnails[accepted]
+        return nearest
+
+    def is_unique(self, distance):
+        return distance is None or distance >= self.min_difference
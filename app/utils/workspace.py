@@ -0,0 +1,109 @@
+# app/utils/workspace.py
+
+import os
+import shutil
+import tempfile
+import logging
+import threading
+from contextlib import contextmanager
+
+from app.config import WORKSPACE_RAM_DIR, WORKSPACE_RAM_BUDGET_MB, WORKSPACE_SIZE_FACTOR
+
+logger = logging.getLogger("metaOfmBot")
+
+def estimate_workspace_bytes(input_size, variant_count, segmented=False):
+    # Input plus one output per variant; None when the input size is unknown.
+    # A segmented render also holds a stream copy of the input (the segments)
+    # and one set of per-variant parts, which coexist with the final outputs
+    # until they are concatenated.
+    if not input_size:
+        return None
+    copies = 1 + variant_count * WORKSPACE_SIZE_FACTOR
+    if segmented:
+        copies += 1 + variant_count * WORKSPACE_SIZE_FACTOR
+    return int(input_size * copies)
+
+class WorkspaceManager:
+    # Hands out per-job working directories. A job goes to tmpfs when its
+    # estimated size fits in what is left of the global RAM budget and
+    # spills to a regular temp directory on disk otherwise. Directories are
+    # removed as soon as the job's context exits.
+
+    def __init__(self, ram_dir, ram_budget_bytes):
+        self.ram_dir = ram_dir
+        self.ram_budget_bytes = ram_budget_bytes
+        self._lock = threading.Lock()
+        self.ram_reserved_bytes = 0
+        self.ram_peak_bytes = 0
+        self.active_ram = 0
+        self.active_disk = 0
+        self.total_ram = 0
+        self.total_disk = 0
+
+    def _ram_dir_usable(self, size):
+        if not self.ram_dir or not os.path.isdir(self.ram_dir) or not os.access(self.ram_dir, os.W_OK):
+            return False
+        return shutil.disk_usage(self.ram_dir).free > size
+
+    def _reserve_ram(self, size):
+        if size is None or not self._ram_dir_usable(size):
+            return False
+        with self._lock:
+            if self.ram_reserved_bytes + size > self.ram_budget_bytes:
+                return False
+            self.ram_reserved_bytes += size
+            self.ram_peak_bytes = max(self.ram_peak_bytes, self.ram_reserved_bytes)
+            self.active_ram += 1
+            self.total_ram += 1
+        return True
+
+    def _release(self, in_ram, size):
+        with self._lock:
+            if in_ram:
+                self.ram_reserved_bytes -= size
+                self.active_ram -= 1
+            else:
+                self.active_disk -= 1
+
+    @contextmanager
+    def workspace(self, estimated_bytes, label="job"):
+        in_ram = self._reserve_ram(estimated_bytes)
+        try:
+            if in_ram:
+                path = tempfile.mkdtemp(prefix="metaofm-", dir=self.ram_dir)
+            else:
+                with self._lock:
+                    self.active_disk += 1
+                    self.total_disk += 1
+                path = tempfile.mkdtemp(prefix="metaofm-")
+        except OSError:
+            self._release(in_ram, estimated_bytes)
+            raise
+
+        # usage() takes the lock; skip it when nobody reads the log line
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Workspace for %s: %s (%s, estimated %s bytes); usage: %s",
+                label, path, "tmpfs" if in_ram else "disk", estimated_bytes or "unknown", self.usage(),
+            )
+        try:
+            yield path
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+            self._release(in_ram, estimated_bytes)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Workspace for %s removed; usage: %s", label, self.usage())
+
+    def usage(self):
+        with self._lock:
+            return {
+                "ram_budget_bytes": self.ram_budget_bytes,
+                "ram_reserved_bytes": self.ram_reserved_bytes,
+                "ram_peak_bytes": self.ram_peak_bytes,
+                "active_ram": self.active_ram,
+                "active_disk": self.active_disk,
+                "total_ram": self.total_ram,
+                "total_disk": self.total_disk,
+            }
+
+workspace_manager = WorkspaceManager(WORKSPACE_RAM_DIR, WORKSPACE_RAM_BUDGET_MB * 1024 * 1024)
@@ -0,0 +1,267 @@
+# benchmarks/run_benchmarks.py
+#
+# End-to-end throughput benchmark on synthetic media, no network needed.
+# Run from the repository root:
+#
+#   python -m benchmarks.run_benchmarks --quick
+#   python -m benchmarks.run_benchmarks --save-baseline benchmarks/baseline.json
+#   python -m benchmarks.run_benchmarks --baseline benchmarks/baseline.json
+#
+# Each case feeds a generated file through handle_file and /process (queue,
+# workers, rendering, metadata checks, delivery) against a fake bot, then
+# times set_metadata_ffmpeg on the same input. With --baseline the run exits
+# non-zero when a case got slower than the tolerance allows.
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+
+def _isolate_state(state_dir):
+    # Databases go to a scratch directory; must happen before app.config is imported
+    os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+    os.environ["JOB_QUEUE_PATH"] = os.path.join(state_dir, "jobs.db")
+    os.environ["PROCESSED_INDEX_PATH"] = os.path.join(state_dir, "processed.db")
+    os.environ["USER_STATE_PATH"] = os.path.join(state_dir, "user_state.db")
+    os.environ["OUTPUT_CACHE_PATH"] = os.path.join(state_dir, "output_cache.db")
+    os.environ["OUTPUT_CACHE_DIR"] = os.path.join(state_dir, "output_cache")
+    # The fake bot has no flood limits; measure processing, not pacing
+    os.environ.setdefault("DELIVERY_CHAT_INTERVAL", "0")
+    os.environ.setdefault("JOB_POLL_INTERVAL", "0.1")
+
+class RssSampler:
+    # Peak resident set size of this process, sampled from /proc in the background
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_kb = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _current_kb():
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_kb = max(self.peak_kb, self._current_kb())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak_kb = self._current_kb()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+def _cpu_seconds():
+    # This process plus reaped children (FFmpeg)
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+def _stage_deltas(before, after):
+    stages = {}
+    for key, (count, total) in after.items():
+        previous_count, previous_total = before.get(key, (0, 0.0))
+        if count > previous_count:
+            stage = key[0]
+            stages[stage] = {
+                "count": count - previous_count,
+                "mean_seconds": round((total - previous_total) / (count - previous_count), 4),
+                "total_seconds": round(total - previous_total, 4),
+            }
+    return stages
+
+async def _wait_for_queue(job_queue):
+    while job_queue.pending_count() or job_queue.running_count():
+        await asyncio.sleep(0.05)
+
+async def run_pipeline_case(spec, input_path, variants, mode, repeat, bot, user_id):
+    from app.handlers.file_handler import handle_file
+    from app.handlers.process import process_command
+    from app.utils.job_queue import job_queue
+    from app.utils.user_state import user_state
+    from app.utils.metrics import STAGE_SECONDS
+    from benchmarks.fake_bot import file_message, fake_update, fake_context
+
+    stages_before = STAGE_SECONDS.snapshot()
+    bytes_before = bot.bytes_sent
+    cpu_before = _cpu_seconds()
+    with RssSampler() as rss:
+        started = time.perf_counter()
+        for iteration in range(repeat):
+            file_id = f"{spec.name}-{user_id}-{iteration}"
+            bot.register_file(file_id, input_path)
+            chat_id = user_id
+            message = file_message(bot, chat_id, iteration * 2 + 1, spec.file_type, file_id, input_path)
+            await handle_file(fake_update(message, user_id), fake_context(bot, []))
+            # The same bytes are reused on every iteration, so skip content-hash dedupe
+            user_state.update(user_id, skip_dedupe=True)
+            command = file_message(bot, chat_id, iteration * 2 + 2, spec.file_type, file_id, input_path)
+            await process_command(fake_update(command, user_id), fake_context(bot, [str(variants), mode]))
+            await _wait_for_queue(job_queue)
+        elapsed = time.perf_counter() - started
+    cpu = _cpu_seconds() - cpu_before
+    total_variants = variants * repeat
+    return {
+        "wall_seconds": round(elapsed, 3),
+        "variants_per_second": round(total_variants / elapsed, 3),
+        "cpu_seconds_per_variant": round(cpu / total_variants, 3),
+        "peak_rss_mb": round(rss.peak_kb / 1024, 1),
+        "uploaded_mb": round((bot.bytes_sent - bytes_before) / 1024 / 1024, 2),
+        "stages": _stage_deltas(stages_before, STAGE_SECONDS.snapshot()),
+    }
+
+def run_direct_case(spec, input_path, scratch_dir):
+    # The synchronous single-variant entry point, without queue or delivery
+    from app.utils.file_processing import set_metadata_ffmpeg
+
+    params = {"brightness": 1.02, "sharpen": 1.05, "temp": 1.03, "contrast": 0.98, "gamma": 1.01}
+    output_path = os.path.join(scratch_dir, f"direct_{spec.name}{spec.ext}")
+    cpu_before = _cpu_seconds()
+    started = time.perf_counter()
+    set_metadata_ffmpeg(input_path, output_path, params)
+    elapsed = time.perf_counter() - started
+    os.remove(output_path)
+    return {
+        "wall_seconds": round(elapsed, 3),
+        "cpu_seconds": round(_cpu_seconds() - cpu_before, 3),
+    }
+
+def compare_with_baseline(results, baseline, tolerance):
+    # Regressions: throughput dropped or CPU per variant grew beyond the tolerance
+    regressions = []
+    for name, current in results["cases"].items():
+        previous = baseline.get("cases", {}).get(name)
+        if previous is None:
+            continue
+        checks = [
+            ("variants_per_second", current["pipeline"]["variants_per_second"],
+             previous["pipeline"]["variants_per_second"], False),
+            ("cpu_seconds_per_variant", current["pipeline"]["cpu_seconds_per_variant"],
+             previous["pipeline"]["cpu_seconds_per_variant"], True),
+        ]
+        if "direct" in current and "direct" in previous:
+            checks.append(("set_metadata_ffmpeg seconds", current["direct"]["wall_seconds"],
+                           previous["direct"]["wall_seconds"], True))
+        for metric, value, reference, lower_is_better in checks:
+            if not reference:
+                continue
+            change = (value - reference) / reference
+            if (change > tolerance) if lower_is_better else (change < -tolerance):
+                regressions.append(f"{name}: {metric} {reference} -> {value} ({change:+.1%})")
+    return regressions
+
+def print_report(results):
+    print(f"\nBenchmark: mode={results['mode']}, variants={results['variants']}, repeat={results['repeat']}, "
+          f"cpus={results['cpu_count']}")
+    for name, case in results["cases"].items():
+        pipeline = case["pipeline"]
+        print(f"\n{name}")
+        print(f"  pipeline: {pipeline['wall_seconds']}s, {pipeline['variants_per_second']} variants/s, "
+              f"{pipeline['cpu_seconds_per_variant']} CPU-s/variant, peak RSS {pipeline['peak_rss_mb']} MB, "
+              f"uploaded {pipeline['uploaded_mb']} MB")
+        for stage, numbers in sorted(pipeline["stages"].items(), key=lambda item: -item[1]["total_seconds"]):
+            print(f"    {stage:<16} n={numbers['count']:<3} mean={numbers['mean_seconds']:.4f}s "
+                  f"total={numbers['total_seconds']:.3f}s")
+        if "direct" in case:
+            print(f"  set_metadata_ffmpeg: {case['direct']['wall_seconds']}s wall, "
+                  f"{case['direct']['cpu_seconds']} CPU-s")
+    print(f"\nPeak RSS of FFmpeg children: {results['peak_child_rss_mb']} MB")
+
+async def run(args, scratch_dir):
+    import logging
+    from app.utils.job_queue import job_queue
+    from app.handlers.process import run_process_job
+    from benchmarks.fake_bot import FakeBot
+    from benchmarks.synthetic_media import MEDIA_SPECS, QUICK_SPECS, ensure_media
+
+    if not args.verbose:
+        logging.getLogger("metaOfmBot").setLevel(logging.WARNING)
+
+    specs = QUICK_SPECS if args.quick else MEDIA_SPECS
+    if args.only:
+        specs = [spec for spec in MEDIA_SPECS if spec.name in args.only]
+
+    bot = FakeBot()
+    await job_queue.start(lambda job: run_process_job(bot, job))
+    results = {
+        "mode": args.mode,
+        "variants": args.variants,
+        "repeat": args.repeat,
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "cases": {},
+    }
+    try:
+        for user_id, spec in enumerate(specs, start=1):
+            input_path = ensure_media(spec, args.media_dir)
+            print(f"Running {spec.name}...", file=sys.stderr)
+            case = {"pipeline": await run_pipeline_case(
+                spec, input_path, args.variants, args.mode, args.repeat, bot, user_id
+            )}
+            if spec.file_type == "video" and not args.skip_direct:
+                case["direct"] = await asyncio.to_thread(run_direct_case, spec, input_path, scratch_dir)
+            results["cases"][spec.name] = case
+    finally:
+        await job_queue.stop()
+    results["peak_child_rss_mb"] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the processing pipeline on synthetic media.")
+    parser.add_argument("--variants", type=int, default=3, help="variants per /process (1-10)")
+    parser.add_argument("--mode", default="full", choices=["full", "meta", "preview"])
+    parser.add_argument("--repeat", type=int, default=1, help="/process runs per input")
+    parser.add_argument("--quick", action="store_true", help="one small video and one photo")
+    parser.add_argument("--only", nargs="+", metavar="CASE", help="run only these cases")
+    parser.add_argument("--skip-direct", action="store_true", help="skip the set_metadata_ffmpeg timing")
+    parser.add_argument("--media-dir", default=os.path.join(tempfile.gettempdir(), "metaofmbot-bench-media"),
+                        help="cache directory for generated inputs")
+    parser.add_argument("--json", metavar="PATH", help="write the full results as JSON")
+    parser.add_argument("--save-baseline", metavar="PATH", help="store the results as the new baseline")
+    parser.add_argument("--baseline", metavar="PATH", help="compare with a stored baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative slowdown (default 0.15)")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO logs")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="metaofmbot-bench-") as scratch_dir:
+        _isolate_state(scratch_dir)
+        results = asyncio.run(run(args, scratch_dir))
+
+    print_report(results)
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            print(f"Results written to {path}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print("\nPerformance regressions against the baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"\nNo regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+if __name__ == "__main__":
+    main()
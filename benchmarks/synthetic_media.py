@@ -0,0 +1,67 @@
+# benchmarks/synthetic_media.py
+
+import os
+import subprocess
+from typing import NamedTuple
+
+from PIL import Image, ImageDraw
+
+class MediaSpec(NamedTuple):
+    name: str
+    file_type: str  # "video" or "photo"
+    width: int
+    height: int
+    duration: float = 0  # seconds, videos only
+    ext: str = ".mp4"
+
+# Default benchmark inputs; "quick" runs use only the first video and photo
+MEDIA_SPECS = [
+    MediaSpec("video_360p_5s", "video", 640, 360, duration=5),
+    MediaSpec("photo_jpeg_1080", "photo", 1080, 1350, ext=".jpg"),
+    MediaSpec("video_720p_15s", "video", 1280, 720, duration=15),
+    MediaSpec("video_1080p_30s", "video", 1920, 1080, duration=30),
+    MediaSpec("photo_jpeg_12mp", "photo", 4000, 3000, ext=".jpg"),
+    MediaSpec("photo_png_1080", "photo", 1080, 1080, ext=".png"),
+]
+QUICK_SPECS = MEDIA_SPECS[:2]
+
+def _generate_video(spec, path):
+    # testsrc pattern plus a sine tone, encoded like a typical phone upload
+    subprocess.run(
+        [
+            "ffmpeg", "-y", "-v", "error",
+            "-f", "lavfi", "-i", f"testsrc=size={spec.width}x{spec.height}:rate=30:duration={spec.duration}",
+            "-f", "lavfi", "-i", f"sine=frequency=440:duration={spec.duration}",
+            "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+            "-c:a", "aac", "-shortest",
+            "-metadata", "title=benchmark", "-metadata", "comment=synthetic input",
+            path,
+        ],
+        check=True,
+    )
+
+def _generate_photo(spec, path):
+    # Gradients with some structure, so sharpening and compression do real work
+    image = Image.linear_gradient("L").resize((spec.width, spec.height))
+    image = Image.merge("RGB", (image, image.rotate(90).resize(image.size), image.transpose(Image.FLIP_LEFT_RIGHT)))
+    draw = ImageDraw.Draw(image)
+    step = max(16, spec.width // 40)
+    for x in range(0, spec.width, step):
+        draw.line([(x, 0), (spec.width - x, spec.height)], fill=(255, 255, 255), width=2)
+    if spec.ext == ".png":
+        image.save(path, format="PNG")
+    else:
+        image.save(path, format="JPEG", quality=92)
+
+def ensure_media(spec, cache_dir):
+    # Generated inputs are deterministic, so they are cached between runs
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, spec.name + spec.ext)
+    if not os.path.exists(path):
+        temp_path = path + ".tmp" + spec.ext
+        if spec.file_type == "video":
+            _generate_video(spec, temp_path)
+        else:
+            _generate_photo(spec, temp_path)
+        os.replace(temp_path, path)
+    return path